@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def chained_codes(thresholds, codes) -> np.ndarray:
+    '''
+        code of each bucket after masked assignments of the later buckets:
+        code assigned to bucket b is reassigned if it falls into one of the next buckets
+    '''
+    res = list(codes)
+    for b in range(len(codes)):
+        val = codes[b]
+        for b_next in range(b + 1, len(codes)):
+            if thresholds[b_next - 1] < val <= thresholds[b_next]:
+                val = codes[b_next]
+        res[b] = val
+    return np.asarray(res)
+
+
+def bucketize(x:np.ndarray, thresholds, lookup:np.ndarray) -> np.ndarray:
+    '''
+        One pass version of
+
+            prv = 0
+            for thr, code in zip(thresholds, codes):
+                x[(prv < x) & (x <= thr)] = code
+                prv = thr
+
+        Args:
+            x(np.ndarray): integer values
+            thresholds: increasing upper bounds of the buckets
+            lookup(np.ndarray): chained_codes(thresholds, codes)
+        Returns:
+            res(np.ndarray): codes of the buckets, values <= 0 and above the last threshold are not changed
+    '''
+    res = x.copy()
+    #bucket b contains thresholds[b - 1] < x <= thresholds[b]
+    b = np.searchsorted(thresholds, x, side='left')
+    inside = (x > 0) & (b < len(thresholds))
+    res[inside] = lookup[b[inside]]
+    return res
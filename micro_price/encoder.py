@@ -22,14 +22,15 @@ class Encoder:
         self.k_dm = len(self.dm_set)
     
     
-    def predict(self, imb, spread, dm=None):
+    def predict(self, imb, spread, dm=None, check=False):
         #round imbalance
         imb = (imb * self.n_imb).astype(int)
-        assert set(imb).issubset(self.imb_set)
+        if check:
+            assert np.all((0 <= imb) & (imb < self.n_imb)), "imbalance is not in imb_set"
         #round spread
-        spread = self.spread_encoder.predict(spread)
+        spread = self.spread_encoder.predict(spread, check)
         if dm is None:
             return imb, spread
         #round dm
-        dm = self.dm_encoder.predict(dm)
+        dm = self.dm_encoder.predict(dm, check)
         return imb, spread, dm
\ No newline at end of file
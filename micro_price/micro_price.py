@@ -1,10 +1,73 @@
+from typing import Optional
+
 import numpy as np
 from encoder import Encoder
 
 
+def _lookup(values, x:np.ndarray) -> np.ndarray:
+    '''
+        vectorized dict( zip( values, range(len(values)) ) )[x] for each element of x,
+        equal values are mapped to the last index as the dict does
+    '''
+    values = np.asarray(values)
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    pos = np.searchsorted(sorted_values, x, side='right') - 1
+    assert np.all(pos >= 0) and np.all(sorted_values[np.maximum(pos, 0)] == x), "unknown state value!"
+    return order[pos]
+
+
+#solvers of G* recursion:
+#   inv    - dense inverse of (I - Q), default
+#   solve  - dense LU solve, inverse is not formed
+#   sparse - sparse Q and T with LU factorization of (I - Q), requires scipy
+SOLVERS = ['inv', 'solve', 'sparse']
+
+
+def _spread_rows(spreads) -> np.ndarray:
+    '''
+        map from spread code to row of G table: rows[code] is index of code in spreads or -1
+    '''
+    spreads = np.asarray(spreads, dtype=np.int64)
+    rows = np.full(spreads.max() + 1, -1, dtype=np.int64)
+    rows[spreads] = np.arange(len(spreads))
+    return rows
+
+
+def _lookup_table(table:np.ndarray, rows:np.ndarray, I:np.ndarray, S:np.ndarray) -> np.ndarray:
+    '''
+        table[rows[S], I] for encoded imbalances I and spread codes S
+    '''
+    S = np.asarray(S, dtype=np.int64)
+    row = rows[np.clip(S, 0, len(rows) - 1)]
+    assert np.all((row >= 0) & (S < len(rows))), "spread is not in G!"
+    return table[row, I]
+
+
 class SimpleMicroPrice:
-    def __init__(self, encoder:Encoder):
+    def __init__(self, encoder:Encoder, solver:str = 'inv', tol:Optional[float] = None, max_iter:int = 100):
+        '''
+            Args:
+                encoder(Encoder): encoder of imbalance, spread and mid price changes
+                solver(str): one of SOLVERS
+                tol(Optional[float]): iterations of G* = G + B @ G* stop when max absolute change is below tol,
+                                      if None exactly max_iter iterations are done
+                max_iter(int): maximum number of iterations
+        '''
+        assert solver in SOLVERS, "unknown solver!"
+        if solver == 'sparse':
+            #scipy is optional, it is checked before fitting
+            try:
+                import scipy.sparse
+            except ImportError as e:
+                raise ImportError("solver='sparse' requires scipy, install it with `pip install scipy`") from e
         self.encoder = encoder
+        self.solver = solver
+        self.tol = tol
+        self.max_iter = max_iter
+        #number of iterations done and max absolute change of G* on each iteration
+        self.n_iter = 0
+        self.residuals = []
     
     
     def fit(self, I, S, dM):
@@ -21,72 +84,101 @@ class SimpleMicroPrice:
         self.i_map  = dict( zip( self.imb_set,     range(n) ) )
         self.s_map  = dict( zip( self.spread_set,  range(m) ) )
         self.dm_map = dict( zip( self.dm_set,      range(k) ) )
-        #memory for probabilities
-        R = np.zeros((n * m , k))
-        T = np.zeros((n * m , n * m))
-        Q = np.zeros((n * m , n * m))
-        #memory for counter
-        cont = np.zeros((n * m, 1))
-        
-        N = len(dM)
-        for idx in range(N):
+        #states before and after each observation and index of dm, original and symmetrized data
+        x, y, j = self._state_codes(I, S, dM)
+        #transitions with dm != 0 go to R and T, others go to Q
+        moved = np.asarray(self.dm_set)[j] != 0.0
 
-            i, i_ = I[idx], I[idx + 1]
-            s, s_ = S[idx], S[idx + 1]
-            dm = dM[idx]
+        cont = np.bincount(x, minlength=n * m).astype(np.float64).reshape(-1, 1)
+        R = np.bincount(x[moved] * k + j[moved], minlength=n * m * k).astype(np.float64).reshape(n * m, k)
+        R /= (cont + 1e-10)
+        R_dm = R @ np.asarray(self.dm_set)
 
-            x = self.i_map[i] * m +  self.s_map[s]
-            y = self.i_map[i_] * m + self.s_map[s_]
-            cont[x] += 1
-            j = self.dm_map[dm]
-            if dm != 0.0:
-                R[x, j] += 1
-                T[x, y] += 1
-            else:
-                Q[x, y] += 1
-
-            #Symmetrize the data
-            i, i_ = n - 1 - I[idx], n - 1 - I[idx + 1]
-            dm = -dM[idx]
-
-            x = self.i_map[i] * m +  self.s_map[s]
-            y = self.i_map[i_] * m + self.s_map[s_]
-            cont[x] += 1
-            j = self.dm_map[dm]
-            if dm != 0.0:
-                R[x, j] += 1
-                T[x, y] += 1
+        G_star = self._solve(R_dm, cont, x[~moved], y[~moved], x[moved], y[moved])
+
+        #state is i * m + s, rows of the table are spread codes, columns are imbalances
+        self.G_table = G_star.reshape(n, m).T.copy()
+        self.spread_rows = _spread_rows(self.spread_set)
+        self.G = { s:list(self.G_table[self.s_map[s]]) for s in self.spread_set }
+        
+
+    def _solve(self, R_dm:np.ndarray, cont:np.ndarray, q_from:np.ndarray, q_to:np.ndarray,
+                     t_from:np.ndarray, t_to:np.ndarray) -> np.ndarray:
+        '''
+            solves G* = G + B @ G*, where G = (I - Q)^-1 @ R @ dm_set and B = (I - Q)^-1 @ T
+
+            Args:
+                R_dm(np.ndarray): R @ dm_set
+                cont(np.ndarray): number of observations of each state, shape (n * m, 1)
+                q_from, q_to(np.ndarray): states of transitions without mid price change
+                t_from, t_to(np.ndarray): states of transitions with mid price change
+            Returns:
+                G_star(np.ndarray): expected mid price change for each state
+        '''
+        nm = len(R_dm)
+        if self.solver == 'sparse':
+            import scipy.sparse as sp
+            from scipy.sparse.linalg import splu
+
+            scale = sp.diags(1.0 / (cont[:, 0] + 1e-10))
+            Q = scale @ sp.csr_matrix( (np.ones(len(q_from)), (q_from, q_to)), shape=(nm, nm) )
+            T = scale @ sp.csr_matrix( (np.ones(len(t_from)), (t_from, t_to)), shape=(nm, nm) )
+            lu = splu( sp.csc_matrix(sp.eye(nm) - Q) )
+            G = lu.solve(R_dm)
+            step = lambda G_star: lu.solve(T @ G_star)
+        else:
+            Q = np.bincount(q_from * nm + q_to, minlength=nm * nm).astype(np.float64).reshape(nm, nm)
+            T = np.bincount(t_from * nm + t_to, minlength=nm * nm).astype(np.float64).reshape(nm, nm)
+            Q /= (cont + 1e-10)
+            T /= (cont + 1e-10)
+            if self.solver == 'inv':
+                Q_inv = np.linalg.inv(np.eye(nm) - Q)
+                G = Q_inv @ R_dm
+                B = Q_inv @ T
             else:
-                Q[x, y] += 1
+                #one factorization for G and B
+                GB = np.linalg.solve(np.eye(nm) - Q, np.column_stack([R_dm, T]))
+                G, B = GB[:, 0], GB[:, 1:]
+            step = lambda G_star: B @ G_star
 
-        R /= (cont + 1e-10)
-        Q /= (cont + 1e-10)
-        T /= (cont + 1e-10)
+        self.residuals = []
+        G_star = G
+        for self.n_iter in range(1, self.max_iter + 1):
+            G_next = G + step(G_star)
+            self.residuals.append( float(np.max(np.abs(G_next - G_star))) )
+            G_star = G_next
+            if not self.tol is None and self.residuals[-1] <= self.tol:
+                break
+        return G_star
+
+
+    def _state_codes(self, I:np.ndarray, S:np.ndarray, dM:np.ndarray):
+        '''
+            maps encoded observations to integer codes of states with array operations
+
+            Returns:
+                x(np.ndarray): state i * m + s before each observation, original data and then symmetrized data
+                y(np.ndarray): state after each observation
+                j(np.ndarray): index of dm in dm_set
+        '''
+        n, m = self.encoder.n_imb, self.encoder.m_spread
+        N = len(dM)
+        I, S, dM = np.asarray(I[:N + 1]), np.asarray(S[:N + 1]), np.asarray(dM, dtype=np.float64)
 
-        Q_inv = np.linalg.inv(np.eye(n * m) - Q)
-        G = Q_inv @ (R @ np.asarray(self.dm_set))
-        B = Q_inv @ T
+        imb_idx = _lookup(self.imb_set, I)
+        spread_idx = _lookup(self.spread_set, S)
+        #symmetrized data: imbalance n - 1 - i and -dm
+        sym_idx = _lookup(self.imb_set, n - 1 - I)
 
-        n_iter = 100
+        x = np.concatenate([ imb_idx[:-1] * m + spread_idx[:-1], sym_idx[:-1] * m + spread_idx[:-1] ])
+        y = np.concatenate([ imb_idx[1:] * m + spread_idx[1:], sym_idx[1:] * m + spread_idx[1:] ])
+        j = np.concatenate([ _lookup(self.dm_set, dM), _lookup(self.dm_set, -dM) ])
+        return x, y, j
 
-        errors = []
-        G_star = G
-        for i in range(n_iter):
-            G_star = G + B @ G_star
-            
-        G_spread = {}
-        for s in self.spread_set:
-            G_spread[s] = []
-            for i in self.imb_set:
-                x = self.i_map[i] * m +  self.s_map[s]
-                G_spread[s].append( G_star[x] )
-        self.G = G_spread    
-        
 
     def predict(self, I:np.ndarray, S:np.ndarray):
         I, S = self.encoder.predict(I, S)
-        predict = np.asarray([ self.G[s][i] for s, i in zip(S, I) ])
-        return predict
+        return _lookup_table(self.G_table, self.spread_rows, I, S)
 
 
 class DummyMicroPrice:
@@ -116,12 +208,14 @@ class DummyMicroPrice:
             self.G[s] = np.zeros((self.encoder.n_imb, ))
             for i in range(self.encoder.n_imb):
                 self.G[s][i] = np.mean(self.dms[s][i])
+        #rows of the table are spreads in order of self.dms
+        self.spread_rows = _spread_rows(list(self.dms.keys()))
+        self.G_table = np.asarray(list(self.G.values())).reshape(-1, self.encoder.n_imb)
 
                 
     def predict(self, I:np.ndarray, S:np.ndarray):
         I, S = self.encoder.predict(I, S)
-        pred = np.asarray([ self.G[s][i] for s, i in zip(S, I) ])
-        return pred
+        return _lookup_table(self.G_table, self.spread_rows, I, S)
 
 
     def apply(self, func):
@@ -140,10 +234,6 @@ class DummyMicroPrice:
     
     def predict_apply(self, I:np.ndarray, S:np.ndarray, func):
         I, S = self.encoder.predict(I, S)
-        G = {}
-        for s in self.dms.keys():
-            G[s] = np.zeros((self.encoder.n_imb, ))
-            for i in range(self.encoder.n_imb):
-                G[s][i] = func(self.dms[s][i])
-        pred = np.asarray( [ G[s][i] for s, i in zip(S, I) ] )
-        return pred
\ No newline at end of file
+        G = self.apply(func)
+        G_table = np.asarray(list(G.values())).reshape(-1, self.encoder.n_imb)
+        return _lookup_table(G_table, self.spread_rows, I, S)
\ No newline at end of file
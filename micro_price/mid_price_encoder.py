@@ -1,5 +1,6 @@
 import numpy as np
 from collections import Counter
+from bucket import bucketize, chained_codes
 
 
 class MidPriceEncoder:
@@ -17,20 +18,18 @@ class MidPriceEncoder:
         self.n_bins = n_bins
 
         
-    def predict(self, dm_:np.ndarray) -> np.ndarray:
+    def predict(self, dm_:np.ndarray, check:bool = False) -> np.ndarray:
         """
             transform given dm
+
+            check: if True, verify that all values are in dm_set
         """
-        dm = dm_.copy()
-        #previous threshold
-        prv = 0
+        dm = np.asarray(dm_)
         dm_int = (np.abs(dm) / self.tick_size).astype(int)
-        for thr, code in zip(self.thresholds, self.codes):
-            idx = (prv < dm_int ) & ( dm_int <= thr) 
-            dm_int[idx] = code
-            prv = thr
+        dm_int = bucketize(dm_int, self.thresholds, self.lookup)
         dm_int = dm_int * np.sign(dm) * self.tick_size
-        assert set(dm_int).issubset(self.dm_set)
+        if check:
+            assert np.all(np.isin(dm_int, self.dm_set)), "dm is not in dm_set"
         return dm_int 
     
     
@@ -72,6 +71,8 @@ class MidPriceEncoder:
                 vals = []
                 
         self.thresholds[-1] = np.inf
+        #code of each bucket for single pass predict
+        self.lookup = chained_codes(self.thresholds, self.codes)
         self.dm_set = sorted( [-code * self.tick_size for code in self.codes] + [0]\
                             + [ code * self.tick_size for code in self.codes] ) 
         self.k_dm = len(self.codes)
@@ -82,7 +83,7 @@ class DummyMidPriceEncoder:
     """
         Dummy Mid Price encoder, just do nothing
     """    
-    def predict(self, dm):
+    def predict(self, dm, check:bool = False):
         return dm
     
     
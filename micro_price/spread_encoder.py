@@ -1,5 +1,6 @@
 import numpy as np
 from collections import Counter
+from bucket import bucketize, chained_codes
 
 class BaseSpreadEncoder:
     def __init__(self, tick_size):
@@ -13,19 +14,14 @@ class BaseSpreadEncoder:
         assert False, "not implemented yet"
 
         
-    def predict(self, spread_):
+    def predict(self, spread_, check:bool = False):
         #clip to be sure spread >= tick_size
-        spread = spread_.copy()
-        spread = np.clip(spread, self.tick_size, np.inf)
+        spread = np.clip(spread_, self.tick_size, np.inf)
         #to int
         spread = (spread / self.tick_size).astype(int)
-        #previous threshold
-        prv = 0
-        for thr, code in zip(self.thresholds, self.codes):
-            idx = (prv < spread) & (spread <= thr) 
-            spread[idx] = code
-            prv = thr
-        assert set(spread).issubset(self.spread_set)
+        spread = bucketize(spread, self.thresholds, self.lookup)
+        if check:
+            assert np.all(np.isin(spread, self.spread_set)), "spread is not in spread_set"
         return spread
 
 
@@ -82,6 +78,8 @@ class UniformSpreadEncoder(BaseSpreadEncoder):
                 cnts = 0
                 vals = []
         self.thresholds[-1] = np.inf
+        #code of each bucket for single pass predict
+        self.lookup = chained_codes(self.thresholds, self.codes)
         self.spread_set = self.codes
         self.m_spread = len(self.codes)
 
@@ -117,6 +115,8 @@ class SpreadEncoder(BaseSpreadEncoder):
                 step += self.step_inc
                 n_steps = 0    
         self.thresholds[-1] = np.inf
+        #code of each bucket for single pass predict
+        self.lookup = chained_codes(self.thresholds, self.codes)
         #for example, if step_inc = 2, max_step = 4
         #thresholds = [1, 2, 3, 4, 7, 10, 13, 16, 21, 26, 31, 36, ..., np.inf]
         self.m_spread = len(self.codes)
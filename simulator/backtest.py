@@ -0,0 +1,364 @@
+'''
+    Event-skipping backtest of strategies with a fixed schedule over columnar market data.
+
+    BestPosStrategy and BaseStrategy place orders at the best positions every `delay` nanoseconds
+    and cancel orders older than a fixed age, so their actions depend only on market data and on
+    their own trades. Instead of passing every update through Sim.tick, this engine visits only
+    the ticks where an order is placed or canceled and the ticks where our trades are received.
+    Best positions of the exchange and of the strategy are computed with MarketData.best_positions,
+    arrival of actions and passive executions are found with searchsorted and numpy comparisons.
+
+    The result is the same as the result of strategy.run(Sim(md, execution_latency, md_latency)).
+'''
+import heapq
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from base_strategy import BaseStrategy
+from market_data import MarketData
+from strategy import BestPosStrategy
+from utils import Order, CancelOrder, OwnTrade, Execution, BID, ASK, BOOK, TRADE
+
+
+#position of an action relative to the md event with the same exchange_ts, see Sim.tick
+PAIRED = 0
+EXECUTE_ORDERS = 1
+ALONE = 2
+
+
+@dataclass
+class _Fill:  # Execution of own order found by the engine
+    order: Order
+    md_idx: int # md event, its exchange_ts is the exchange_ts of the trade
+    price: float
+    execute: str
+    key: tuple # order of execution in Sim, defines trade_id
+    valid: bool = True
+
+
+class _Exchange:
+    '''
+        Exchange side of Sim: best positions and crossing prices after each md event
+    '''
+    def __init__(self, md:MarketData, md_latency:float) -> None:
+        self.exchange_ts = md.exchange_ts
+        self.md_latency = md_latency
+        self.best_bid, self.best_ask = md.best_positions()
+
+        has_trade = md.trade_idx >= 0
+        trade_side  = np.zeros(len(md), dtype=np.int8)
+        trade_price = np.zeros(len(md))
+        trade_side[has_trade]  = md.trades.side[md.trade_idx[has_trade]]
+        trade_price[has_trade] = md.trades.price[md.trade_idx[has_trade]]
+        #bid is executed by execute_orders if price >= cross_bid, ask is executed if -price >= neg_cross_ask
+        self.cross_bid = np.minimum(self.best_ask, np.where(trade_side == -1, trade_price, np.inf))
+        self.neg_cross_ask = -np.maximum(self.best_bid, np.where(trade_side == 1, trade_price, -np.inf))
+
+
+    def __len__(self) -> int:
+        return len(self.exchange_ts)
+
+
+    def position(self, ts:float, rank:int) -> Tuple[int, int]:
+        '''
+            This function finds md event processed together with the action
+
+            Args:
+                ts(float): exchange_ts of the action
+                rank(int): number of the action among actions with the same exchange_ts
+            Returns:
+                md_idx(int): index of the current md when the action is processed, -1 if there is no md yet
+                phase(int): PAIRED if the action is processed together with md_idx, ALONE if after it
+        '''
+        lo = int(self.exchange_ts.searchsorted(ts, side='left'))
+        hi = int(self.exchange_ts.searchsorted(ts, side='right'))
+        if rank < hi - lo:
+            return lo + rank, PAIRED
+        return hi - 1, ALONE
+
+
+    def execute_last_order(self, order:Order, k:int) -> Optional[Tuple[float, Execution]]:
+        if k < 0:
+            return None
+        if order.side == BID and order.price >= self.best_ask[k]:
+            return float(self.best_ask[k]), BOOK
+        if order.side == ASK and order.price <= self.best_bid[k]:
+            return float(self.best_bid[k]), BOOK
+        return None
+
+
+    def first_cross(self, order:Order, start:int, end:int) -> int:
+        '''
+            Returns:
+                k(int): first md event in [start, end) which executes resting order, -1 if there is none
+        '''
+        if order.side == BID:
+            hit = self.cross_bid[start:end] <= order.price
+        else:
+            hit = self.neg_cross_ask[start:end] <= -order.price
+        i = int(hit.argmax()) if len(hit) else 0
+        return start + i if len(hit) and hit[i] else -1
+
+
+    def execute_type(self, order:Order, k:int) -> Execution:
+        if order.side == BID:
+            return BOOK if order.price >= self.best_ask[k] else TRADE
+        return BOOK if order.price <= self.best_bid[k] else TRADE
+
+
+def _warm_up_end(ticks:np.ndarray, T:float) -> int:
+    '''
+        Returns:
+            i(int): index of the first tick after BaseStrategy._warm_up
+    '''
+    if len(ticks) < 2:
+        return len(ticks)
+    #first receive_ts in the queue of BaseStrategy before the i-th tick
+    first = ticks[ticks.searchsorted(ticks[:-1] - T, side='left')]
+    stop = np.flatnonzero(ticks[1:] - first > T)
+    return int(stop[0]) + 2 if len(stop) else len(ticks)
+
+
+class _Backtest:
+    def __init__(self, strategy:Union[BestPosStrategy, BaseStrategy], md:MarketData,
+                       execution_latency:float, md_latency:float) -> None:
+        assert execution_latency > 0 and md_latency > 0, "latency should be positive!"
+        assert strategy.delay > 0, "delay should be positive!"
+        assert np.all(md.receive_ts >= md.exchange_ts), "receive_ts should not be less than exchange_ts!"
+
+        self.strategy = strategy
+        self.latency = execution_latency
+        self.md_latency = md_latency
+        self.exchange = _Exchange(md, md_latency)
+
+        #strategy receives md in order of receive_ts
+        order = np.argsort(md.receive_ts, kind='stable')
+        self.receive_ts = md.receive_ts[order]
+        self.best_bid, self.best_ask = md.best_positions(order)
+        #md ticks of the strategy
+        self.ticks = np.unique(self.receive_ts)
+
+        if type(strategy) is BestPosStrategy:
+            self.hold_time = strategy.hold_time
+            first_tick = 0
+        elif type(strategy) is BaseStrategy:
+            self.hold_time = strategy.delay
+            first_tick = _warm_up_end(self.ticks, strategy.T)
+        else:
+            assert False, "only BestPosStrategy and BaseStrategy are supported!"
+
+        #index of the first md tick which is not received yet
+        self.md_tick = first_tick
+        #maximum receive_ts of received ticks
+        self.max_ts = self.ticks[first_tick - 1] if first_tick > 0 else -np.inf
+        self.prev_time = -np.inf
+        self.btc_pos = 0.0
+
+        self.order_id = 0
+        self.all_orders:List[Order] = []
+        #orders that have not been executed/canceled yet from the point of view of the strategy
+        self.ongoing_orders:Dict[int, Order] = {}
+        #resting orders without execution found: order_id -> [order, searched up to md event, position in book]
+        self.resting:Dict[int, list] = {}
+        self.fills:Dict[int, _Fill] = {}
+        #fills which are not received yet: (receive position, number, fill)
+        self.fills_queue:List[Tuple[float, int, int, int, _Fill]] = []
+        self.n_fills = 0
+
+
+    def _push_fill(self, fill:_Fill, ts:float, rank:int) -> None:
+        '''
+            Fill with receive_ts >= processing time is received in order of receive_ts.
+            Aggressive fill of an order that came after the last md gets receive_ts less than
+            the time it is processed at, Sim returns it just after processing the order.
+        '''
+        self.fills[fill.order.order_id] = fill
+        receive_ts = int(self.exchange.exchange_ts[fill.md_idx]) + self.md_latency
+        if receive_ts >= ts:
+            item = (receive_ts, 1, 0, self.n_fills, fill)
+        else:
+            item = (ts, 0, rank, self.n_fills, fill)
+        self.n_fills += 1
+        heapq.heappush(self.fills_queue, item)
+
+
+    def _place(self, order:Order, rank:int) -> None:
+        ts = order.exchange_ts
+        k, phase = self.exchange.position(ts, rank)
+        res = self.exchange.execute_last_order(order, k)
+        if not res is None:
+            price, execute = res
+            key = (k, phase, ts, rank, 0, 0) if phase == ALONE else (k, phase, 0, 0, 0, 0)
+            self._push_fill(_Fill(order, k, price, execute, key), ts, rank)
+            return
+        #paired order rests before execute_orders of the same md
+        start = k if phase == PAIRED else k + 1
+        self.resting[order.order_id] = [order, start, (k, phase, ts, rank)]
+
+
+    def _search(self, order_id:int, end:int) -> bool:
+        order, start, book_key = self.resting[order_id]
+        if start >= end:
+            return False
+        k = self.exchange.first_cross(order, start, end)
+        if k < 0:
+            self.resting[order_id][1] = end
+            return False
+        self.resting.pop(order_id)
+        key = (k, EXECUTE_ORDERS) + book_key
+        fill = _Fill(order, k, order.price, self.exchange.execute_type(order, k), key)
+        self._push_fill(fill, self.exchange.exchange_ts[k], 0)
+        return True
+
+
+    def _cancel(self, order_id:int, ts:float, rank:int) -> None:
+        k, phase = self.exchange.position(ts, rank)
+        #md events after the cancel can't execute the order
+        end = k if phase == PAIRED else k + 1
+        if order_id in self.resting:
+            self._search(order_id, end)
+            self.resting.pop(order_id, None)
+        else:
+            fill = self.fills[order_id]
+            if fill.key[1] == EXECUTE_ORDERS and fill.md_idx >= end:
+                fill.valid = False
+
+
+    def _act(self, receive_ts:float) -> None:
+        '''
+            actions of the strategy after updates with receive_ts are received
+        '''
+        strategy = self.strategy
+        actions:List[Union[Order, CancelOrder]] = []
+        if receive_ts - self.prev_time >= strategy.delay:
+            self.prev_time = receive_ts
+            i = self.receive_ts.searchsorted(receive_ts, side='right') - 1
+            best_bid = float(self.best_bid[i]) if i >= 0 else -np.inf
+            best_ask = float(self.best_ask[i]) if i >= 0 else np.inf
+            if type(strategy) is BaseStrategy:
+                strategy._calculate_order_position(self.btc_pos / strategy.min_pos)
+                bid_pos, ask_pos = strategy.bid_pos, strategy.ask_pos
+            else:
+                bid_pos, ask_pos = strategy.min_pos, strategy.min_pos
+            exchange_ts = receive_ts + self.latency
+            for side, size, price in [(BID, bid_pos, best_bid), (ASK, ask_pos, best_ask)]:
+                order = Order(receive_ts, exchange_ts, self.order_id, side, size, price)
+                self.order_id += 1
+                self.ongoing_orders[order.order_id] = order
+                self.all_orders.append(order)
+                actions.append(order)
+
+        for ID, order in self.ongoing_orders.items():
+            if order.place_ts < receive_ts - self.hold_time:
+                actions.append(CancelOrder(receive_ts + self.latency, ID))
+        for action in actions:
+            if isinstance(action, CancelOrder):
+                self.ongoing_orders.pop(action.id_to_delete)
+
+        for rank, action in enumerate(actions):
+            if isinstance(action, Order):
+                self._place(action, rank)
+            else:
+                self._cancel(action.id_to_delete, action.exchange_ts, rank)
+
+
+    def _receive(self, fill:_Fill) -> None:
+        order = fill.order
+        self.ongoing_orders.pop(order.order_id, None)
+        sgn = 1.0 if order.side == BID else -1.0
+        self.btc_pos += sgn * order.size
+
+
+    def _next_md_tick(self) -> int:
+        '''
+            Returns:
+                i(int): index of the next md tick where the strategy places or cancels orders
+        '''
+        ticks = self.ticks
+        i = int(ticks.searchsorted(self.prev_time + self.strategy.delay, side='left'))
+        if len(self.ongoing_orders):
+            oldest = next(iter(self.ongoing_orders.values()))
+            i = min(i, int(ticks.searchsorted(oldest.place_ts + self.hold_time, side='right')))
+        return max(i, self.md_tick)
+
+
+    def _fills_head(self) -> Optional[tuple]:
+        while len(self.fills_queue) and not self.fills_queue[0][-1].valid:
+            heapq.heappop(self.fills_queue)
+        return self.fills_queue[0] if len(self.fills_queue) else None
+
+
+    def run(self) -> Tuple[List[OwnTrade], List[Order]]:
+        ticks = self.ticks
+        while True:
+            i = self._next_md_tick()
+            md_pos = (int(ticks[i]), 1) if i < len(ticks) else (np.inf, 1)
+            head = self._fills_head()
+            pos = md_pos if head is None or md_pos <= head[:2] else head[:2]
+
+            #passive executions received up to the next tick
+            end = int(self.exchange.exchange_ts.searchsorted(pos[0] - self.md_latency, side='right'))
+            found = False
+            for order_id in list(self.resting):
+                found |= self._search(order_id, end)
+            if found:
+                continue
+            if pos[0] == np.inf:
+                break
+
+            ts, kind = pos
+            #md ticks before the position are received
+            lo = int(ticks.searchsorted(ts, side='left'))
+            if lo > 0:
+                self.max_ts = max(self.max_ts, ticks[lo - 1])
+            if kind == 1:
+                self.md_tick = max(self.md_tick, int(ticks.searchsorted(ts, side='right')))
+                receive_ts = ts
+                while not head is None and head[:2] == pos:
+                    heapq.heappop(self.fills_queue)
+                    self._receive(head[-1])
+                    head = self._fills_head()
+            else:
+                self.md_tick = max(self.md_tick, lo)
+                heapq.heappop(self.fills_queue)
+                fill = head[-1]
+                self._receive(fill)
+                receive_ts = int(self.exchange.exchange_ts[fill.md_idx]) + self.md_latency
+
+            #updates with receive_ts not greater than received before don't change actions of the strategy
+            if receive_ts > self.max_ts:
+                self._act(receive_ts)
+            self.max_ts = max(self.max_ts, receive_ts)
+
+        return self._trades(), self.all_orders
+
+
+    def _trades(self) -> List[OwnTrade]:
+        fills = sorted([fill for fill in self.fills.values() if fill.valid], key=lambda fill: fill.key)
+        trades_list = []
+        for trade_id, fill in enumerate(fills):
+            order = fill.order
+            exchange_ts = int(self.exchange.exchange_ts[fill.md_idx])
+            trades_list.append( OwnTrade(order.place_ts, exchange_ts, exchange_ts + self.md_latency, trade_id,
+                                         order.order_id, order.side, order.size, fill.price, fill.execute) )
+        return trades_list
+
+
+def backtest(strategy:Union[BestPosStrategy, BaseStrategy], md:MarketData,
+             execution_latency:float, md_latency:float) -> Tuple[List[OwnTrade], List[Order]]:
+    '''
+        This function runs the strategy without Sim, the result is the same as
+        the result of strategy.run(Sim(md, execution_latency, md_latency))
+
+        Args:
+            strategy(Union[BestPosStrategy, BaseStrategy]): strategy, subclasses of BaseStrategy are not supported
+            md(MarketData): market data, receive_ts should not be less than exchange_ts
+            execution_latency(float): latency in nanoseconds, should be positive
+            md_latency(float): latency in nanoseconds, should be positive
+        Returns:
+            trades_list(List[OwnTrade]): list of our executed trades
+            all_orders(List[Order]): list of all placed orders
+    '''
+    return _Backtest(strategy, md, execution_latency, md_latency).run()
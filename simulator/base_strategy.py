@@ -1,20 +1,54 @@
 from typing import List, Optional, Tuple, Union, Dict, Deque
 
-from collections import deque, defaultdict
 import numpy as np
 import pandas as pd
 
 from simulator import MdUpdate, Order, OwnTrade, Sim
 
 
-from utils import get_mid_price, update_best_positions, Order, OwnTrade, MdUpdate
+from utils import BookState, Order, OwnTrade, ExpiredOrder, MdUpdate, Side, BID, ASK
+from recorder import RingBuffer, RunRecorder
 
 
 
+def quote(sim:Sim, ts:float, ongoing_orders:Dict[int, Order], size:float, side:Side, price:float,
+          ttl:Optional[float] = None) -> Tuple[Order, bool]:
+    '''
+        This function keeps one live order on the side: ongoing order of the side is amended,
+        new order is placed if there is none
+
+        Args:
+            sim(Sim): simulator
+            ts(float): current timestamp
+            ongoing_orders(Dict[int, Order]): orders that have not been executed/canceled yet, updated in place
+            size(float): size of the order
+            side(Side): side of the order
+            price(float): price of the order
+            ttl(Optional[float]): time-in-force of the new order, amended order keeps its expire_ts
+        Returns:
+            order(Order): live order of the side
+            placed(bool): True if new order was placed
+    '''
+    for order in ongoing_orders.values():
+        if order.side == side:
+            amend = sim.amend_order(ts, order.order_id, size, price)
+            order = Order(ts, amend.exchange_ts, order.order_id, side, size, price, order.expire_ts)
+            ongoing_orders[order.order_id] = order
+            return order, False
+    order = sim.place_order(ts, size, side, price, ttl)
+    ongoing_orders[order.order_id] = order
+    return order, True
+
+
 class BaseStrategy:
     '''
         This strategy places ask and bid order every `delay` nanoseconds.
     '''
+    #fields of the queues over the last T nanoseconds
+    QUEUE_FIELDS = ['receive_ts', 'mid_price', 'best_ask', 'best_bid']
+    #fields recorded on every tick and returned by run
+    RECORD_FIELDS = ['mid_price', 'best_ask', 'best_bid', 'ask_price', 'bid_price', 'receive_ts']
+
     def __init__(self, delay: float, min_pos:float, T:int, inventory_policy='neutral', q0=1.0) -> None:
         '''
             Args:
@@ -37,12 +71,13 @@ class BaseStrategy:
         self.T = T
 
         self.mid_price = None
+        #orderbook received by strategy
+        self.book = BookState()
 
         self._inventory_policy = inventory_policy
         self.q0 = q0
 
-        keys = ['receive_ts', 'mid_price', 'best_ask', 'best_bid']
-        self.queues = { k:deque() for k in keys}
+        self.queues = RingBuffer(self.QUEUE_FIELDS)
         assert inventory_policy in ['neutral', 'aggressive', 'linear']
 
 
@@ -51,32 +86,28 @@ class BaseStrategy:
         '''
             updates best positions
         '''
-        self.best_bid, self.best_ask = update_best_positions(self.best_bid, self.best_ask, md)
-        if self.mid_price is None:
-            self.mid_price = 0.5 * (self.best_ask + self.best_bid)
-        self.mid_price = get_mid_price(self.mid_price, md)
+        self.book.update(md)
+        self.best_bid, self.best_ask = self.book.best_bid, self.book.best_ask
+        #weighted mid price of the last snapshot
+        self.mid_price = self.book.weighted_mid
 
 
     def _update_queues(self):
-        self.queues['mid_price'].append(self.mid_price)
-        self.queues['best_ask'].append(self.best_ask)
-        self.queues['best_bid'].append(self.best_bid)
-        self.queues['receive_ts'].append(self.receive_ts)
-
-        while len(self.queues['receive_ts']) and self.receive_ts - self.queues['receive_ts'][0] > self.T:
-            for k, queue in self.queues.items():
-                queue.popleft()
+        self.queues.append( (self.receive_ts, self.mid_price, self.best_ask, self.best_bid) )
+        #remove rows with self.receive_ts - receive_ts > T
+        self.queues.popleft_while_less('receive_ts', self.receive_ts - self.T)
 
 
-    def _update_lists(self):
-        self.lists['mid_price'].append(self.mid_price)
-        self.lists['best_ask'].append(self.best_ask)
-        self.lists['best_bid'].append(self.best_bid)
+    def _record_row(self) -> tuple:
+        '''
+            Returns:
+                row(tuple): values of RECORD_FIELDS
+        '''
+        return (self.mid_price, self.best_ask, self.best_bid, self.ask_price, self.bid_price, self.receive_ts)
 
-        self.lists['ask_price'].append(self.ask_price)
-        self.lists['bid_price'].append(self.bid_price)
 
-        self.lists['receive_ts'].append(self.receive_ts)
+    def _update_lists(self, has_trade:bool = False):
+        self.recorder.add_row(self.receive_ts, self._record_row, has_trade)
         
 
 
@@ -89,17 +120,16 @@ class BaseStrategy:
             if updates is None:
                 break
             
-            self.lists['update'] += updates
+            self.recorder.add_updates(updates)
             
-            if len(self.queues['receive_ts']) and self.receive_ts - self.queues['receive_ts'][0] > self.T:
+            if len(self.queues) and self.receive_ts - self.queues.first('receive_ts') > self.T:
                 go = False
 
             for md in updates:
                 assert isinstance(md, MdUpdate), "wrong update type!"
 
-                self.lists['md'].append(md)
-                
                 self._update_md(md)
+                self.recorder.add_md(md, self.best_bid, self.best_ask)
                 self._update_lists()
                 self._update_queues()            
 
@@ -139,17 +169,31 @@ class BaseStrategy:
 
 
 
-    def run(self, sim: Sim ):
+    def run(self, sim: Sim, record:str = 'full', sample_every:Optional[float] = None, cost:float = -0.00001,
+            equity_every:Optional[float] = None, amend:bool = False, expire:bool = False):
         '''
             This function runs simulation
 
             Args:
                 sim(Sim): simulator
+                record(str): recording level, one of recorder.RECORD_LEVELS
+                sample_every(Optional[float]): sampling period in nanoseconds for 'sampled' level,
+                                               if None fields are recorded on ticks with own trades
+                cost(float): fee per unit of traded notional for PnL summary
+                equity_every(Optional[float]): sampling period of the equity curve in nanoseconds,
+                                               the curve is available in self.recorder.pnl.equity_curve()
+                amend(bool): if True, one order per side is kept and amended instead of placing new orders
+                expire(bool): if True, orders are placed with ttl = delay and expired by simulator
+                              instead of being canceled by strategy, ticks with expirations only are skipped
+            Returns:
+                res(dict): recorded fields, lists of trades, md, updates and placed orders
+                           (empty if they are not recorded) and PnL summary
         '''
 
         self.receive_ts = 0.0
 
-        self.lists = defaultdict(list)
+        #updates received by strategy and fields on ticks
+        self.recorder = RunRecorder(record, self.RECORD_FIELDS, sample_every, cost, equity_every)
         
         #current best positions
         self.best_bid = -np.inf
@@ -163,7 +207,8 @@ class BaseStrategy:
         prev_time = -np.inf
         #orders that have not been executed/canceled yet
         ongoing_orders: Dict[int, Order] = {}
-        all_orders = []
+        #time-in-force of the orders, None if strategy cancels them
+        ttl = self.delay if expire else None
 
         self._warm_up(sim)    
         btc_pos = 0.0
@@ -173,58 +218,60 @@ class BaseStrategy:
             if updates is None:
                 break
             #save updates
-            self.lists['update'] += updates
+            self.recorder.add_updates(updates)
             
+            has_trade = False
             for update in updates:
                 if isinstance(update, MdUpdate):
-                    self.lists['md'].append(update)
                     self._update_md(update)
+                    self.recorder.add_md(update, self.best_bid, self.best_ask)
                 elif isinstance(update, OwnTrade):
-                    self.lists['trade'].append(update)
+                    has_trade = True
+                    self.recorder.add_trade(update)
                     #delete executed trades from the dict
                     if update.order_id in ongoing_orders.keys():
                         ongoing_orders.pop(update.order_id)
-                    sgn = 1.0 if update.side == 'BID' else -1.0
+                    sgn = 1.0 if update.side == BID else -1.0
                     btc_pos += sgn * update.size
+                elif isinstance(update, ExpiredOrder):
+                    ongoing_orders.pop(update.order_id, None)
                 else: 
                     assert False, 'invalid type of update!'
+            #tick with expirations only doesn't change the market, strategy doesn't requote on it
+            if all(isinstance(update, ExpiredOrder) for update in updates):
+                continue
             
             inventory = btc_pos / self.min_pos
             self._calculate_order_prices(inventory)
             self._calculate_order_position(inventory)
 
             self._update_queues()
-            self._update_lists()
+            self._update_lists(has_trade)
 
             if self.receive_ts - prev_time >= self.delay:
                 prev_time = self.receive_ts
-                #place order
-                bid_order = sim.place_order( self.receive_ts, self.bid_pos, 'BID', self.bid_price )
-                ask_order = sim.place_order( self.receive_ts, self.ask_pos, 'ASK', self.ask_price )
-                ongoing_orders[bid_order.order_id] = bid_order
-                ongoing_orders[ask_order.order_id] = ask_order
-
-                all_orders += [bid_order, ask_order]
+                if amend:
+                    #amend live orders, only new orders are recorded
+                    quotes = [ quote(sim, self.receive_ts, ongoing_orders, self.bid_pos, BID, self.bid_price, ttl),
+                               quote(sim, self.receive_ts, ongoing_orders, self.ask_pos, ASK, self.ask_price, ttl) ]
+                    self.recorder.add_orders([ order for order, placed in quotes if placed ])
+                else:
+                    #place order
+                    bid_order = sim.place_order( self.receive_ts, self.bid_pos, BID, self.bid_price, ttl )
+                    ask_order = sim.place_order( self.receive_ts, self.ask_pos, ASK, self.ask_price, ttl )
+                    ongoing_orders[bid_order.order_id] = bid_order
+                    ongoing_orders[ask_order.order_id] = ask_order
+
+                    self.recorder.add_orders([bid_order, ask_order])
             
             #cancel orders
-            to_cancel = []
-            for ID, order in ongoing_orders.items():
-                if order.place_ts < self.receive_ts - self.delay:
-                    sim.cancel_order( self.receive_ts, ID )
-                    to_cancel.append(ID)
-            for ID in to_cancel:
-                ongoing_orders.pop(ID)
-
-        res = dict(self.lists)
-        
-        
-        #array_keys = ['mid_price', 'best_ask', 'best_bid', 'res_price', 'ask_price', 'bid_price']
-
-        #for k in array_keys:
-        #    res[k] = np.asarray(self.lists[k])
-        
-        res['trade'] = self.lists['trade']
-        res['md'] = self.lists['md']
-        res['update'] = self.lists['update']
-
-        return res
+            if not expire:
+                to_cancel = []
+                for ID, order in ongoing_orders.items():
+                    if order.place_ts < self.receive_ts - self.delay:
+                        sim.cancel_order( self.receive_ts, ID )
+                        to_cancel.append(ID)
+                for ID in to_cancel:
+                    ongoing_orders.pop(ID)
+
+        return self.recorder.result()
@@ -0,0 +1,320 @@
+'''
+    Benchmarks of the simulator on recorded market data
+
+    Usage:
+        python benchmarks.py sim --path ../md/btcusdt:Binance:LinearPerpetual/ --minutes 10
+'''
+import argparse
+import dataclasses
+import time
+import tracemalloc
+from collections import deque
+from typing import Callable, Deque, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from simulator import Sim
+from strategy import BestPosStrategy
+from load_data import load_md_from_file, load_books, load_trades, merge_books_and_trades, stream_md_from_file
+from backtest import backtest
+from get_info import get_pnl, get_pnl_arrays
+from utils import OwnTrade, BID, ASK, BOOK
+import utils
+
+
+def _best_time(func:Callable[[], None], n_runs:int) -> float:
+    times = []
+    for _ in range(n_runs):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+class PollingSim(Sim):
+    '''
+        Reference Sim with the tick loop used before the event scheduler:
+        md queue, actions queue and strategy updates queue are polled on every iteration.
+        Expiration of orders is not supported.
+    '''
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.actions_queue:Deque = deque()
+
+
+    def _push_md_event(self) -> None:
+        pass
+
+
+    def _push_action(self, action) -> None:
+        self.actions_queue.append(action)
+
+
+    def _push_expiration(self, order) -> None:
+        pass
+
+
+    def tick(self):
+        while True:
+            #get event time for all the queues
+            strategy_updates_queue_et = self.strategy_updates_queue.min_key()
+            md_queue_et = self.md_queue.head_ts()
+            actions_queue_et = np.inf if len(self.actions_queue) == 0 else self.actions_queue[0].exchange_ts
+
+            #if both queue are empty
+            if md_queue_et == np.inf and actions_queue_et == np.inf:
+                break
+
+            #strategy queue has minimum event time
+            if strategy_updates_queue_et < min(md_queue_et, actions_queue_et):
+                break
+
+            call_execute = md_queue_et <= actions_queue_et
+            if md_queue_et <= actions_queue_et:
+                self.update_md( self.md_queue.popleft() )
+            if actions_queue_et <= md_queue_et:
+                self.update_action( self.actions_queue.popleft() )
+                #execute last order aggressively
+                self.execute_last_order()
+
+            #execute orders with current orderbook
+            if call_execute:
+                self.execute_orders()
+            #delete last trade
+            self.delete_last_trade()
+        return self.strategy_updates_queue.pop()
+
+
+def bench_sim(md, n_runs:int = 3) -> Dict[str, float]:
+    '''
+        This function measures how many events per second Sim processes with BestPosStrategy
+        and compares it with the polling loop used before the event scheduler (PollingSim)
+
+        Returns:
+            res(Dict[str, float]): number of md events and actions, time in seconds and events per second
+                                   of both loops and speedup
+    '''
+    latency = pd.Timedelta(10, 'ms').value
+    md_latency = pd.Timedelta(10, 'ms').value
+    delay = pd.Timedelta(0.1, 's').value
+    hold_time = pd.Timedelta(10, 's').value
+
+    sims, results = [], {}
+    def run(cls):
+        sim = cls(md, latency, md_latency)
+        results[cls] = BestPosStrategy(delay, hold_time).run(sim)[0]
+        sims.append(sim)
+
+    seconds = _best_time(lambda: run(Sim), n_runs)
+    #md events and actions
+    n_events = sims[-1].events.n_pushed
+    polling_seconds = _best_time(lambda: run(PollingSim), n_runs)
+    assert results[Sim] == results[PollingSim], "Sim differs from the polling loop!"
+    return {'md_events': len(md), 'events': n_events, 'seconds': seconds, 'events_per_second': n_events / seconds,
+            'polling_seconds': polling_seconds, 'polling_events_per_second': n_events / polling_seconds,
+            'speedup': polling_seconds / seconds}
+
+
+def bench_backtest(md, n_runs:int = 3) -> Dict[str, float]:
+    '''
+        This function compares Sim and backtest with BestPosStrategy
+
+        Returns:
+            res(Dict[str, float]): time in seconds of both engines and speedup
+    '''
+    latency = pd.Timedelta(10, 'ms').value
+    md_latency = pd.Timedelta(10, 'ms').value
+    delay = pd.Timedelta(0.1, 's').value
+    hold_time = pd.Timedelta(10, 's').value
+
+    results = {}
+    def run_sim():
+        results['sim'] = BestPosStrategy(delay, hold_time).run(Sim(md, latency, md_latency))[0]
+    def run_backtest():
+        results['backtest'] = backtest(BestPosStrategy(delay, hold_time), md, latency, md_latency)[0]
+
+    sim_seconds = _best_time(run_sim, n_runs)
+    backtest_seconds = _best_time(run_backtest, n_runs)
+    assert results['sim'] == results['backtest'], "backtest differs from Sim!"
+    return {'md_events': len(md), 'trades': len(results['sim']), 'sim_seconds': sim_seconds,
+            'backtest_seconds': backtest_seconds, 'speedup': sim_seconds / backtest_seconds}
+
+
+def bench_pnl(md, n_runs:int = 3) -> Dict[str, float]:
+    '''
+        This function compares get_pnl over the list of updates with vectorized get_pnl_arrays
+        on trades of BestPosStrategy
+
+        Returns:
+            res(Dict[str, float]): time in seconds of the loop, of get_pnl with columnar md
+                                   and of get_pnl_arrays with prepared arrays, speedup
+    '''
+    latency = pd.Timedelta(10, 'ms').value
+    md_latency = pd.Timedelta(10, 'ms').value
+    delay = pd.Timedelta(0.1, 's').value
+    hold_time = pd.Timedelta(10, 's').value
+
+    trades, _, updates, _ = BestPosStrategy(delay, hold_time).run(Sim(md, latency, md_latency))
+    order = np.argsort(md.receive_ts, kind='stable')
+    best_bid, best_ask = md.best_positions(order)
+    md_receive_ts = md.receive_ts[order]
+    trade_receive_ts = np.asarray([trade.receive_ts for trade in trades], dtype=np.int64)
+    side = np.asarray([trade.side for trade in trades])
+    size = np.asarray([trade.size for trade in trades])
+    price = np.asarray([trade.price for trade in trades])
+
+    results = {}
+    def run_loop():
+        results['loop'] = get_pnl(updates)
+    def run_md():
+        results['md'] = get_pnl(updates, md=md)
+    def run_arrays():
+        results['arrays'] = get_pnl_arrays(trade_receive_ts, side, size, price, md_receive_ts, best_bid, best_ask)
+
+    loop_seconds = _best_time(run_loop, n_runs)
+    md_seconds = _best_time(run_md, n_runs)
+    arrays_seconds = _best_time(run_arrays, n_runs)
+    #Sim can deliver a fill with receive_ts below the one of md delivered before it,
+    #vectorized versions merge by (receive_ts, md before trade), so the loop reference gets updates in this order
+    ordered = sorted(updates, key=lambda update: (update.receive_ts, isinstance(update, OwnTrade)))
+    loop = get_pnl(ordered).groupby('receive_ts')['total'].last().to_numpy()
+    for name in ['md', 'arrays']:
+        res = results[name].groupby('receive_ts')['total'].last().to_numpy()
+        assert np.allclose(loop, res, equal_nan=True), f"get_pnl {name} differs from the loop!"
+    return {'rows': len(results['loop']), 'trades': len(trades), 'loop_seconds': loop_seconds,
+            'md_seconds': md_seconds, 'arrays_seconds': arrays_seconds, 'speedup': loop_seconds / arrays_seconds}
+
+
+def bench_expire(md, n_runs:int = 3) -> Dict[str, float]:
+    '''
+        This function compares BestPosStrategy with orders expired by Sim (expire=True) to the cancel scan.
+        Run with expiration ends with market data. Trades are the same until the first fill of the cancel scan
+        after expire_ts of the order: cancel is sent on the first tick after hold_time, so the order rests longer.
+        Without such fills the trades are the same.
+
+        Returns:
+            res(Dict[str, float]): time in seconds of both runs and number of fills after expire_ts
+    '''
+    latency = pd.Timedelta(10, 'ms').value
+    md_latency = pd.Timedelta(10, 'ms').value
+    delay = pd.Timedelta(0.1, 's').value
+    hold_time = pd.Timedelta(10, 's').value
+
+    results = {}
+    def run_scan():
+        results['scan'] = BestPosStrategy(delay, hold_time).run(Sim(md, latency, md_latency))
+    def run_expire():
+        results['expire'] = BestPosStrategy(delay, hold_time).run(Sim(md, latency, md_latency), expire=True)
+
+    scan_seconds = _best_time(run_scan, n_runs)
+    expire_seconds = _best_time(run_expire, n_runs)
+    (scan, _, _, orders), (expire, _, updates, _) = results['scan'], results['expire']
+    last_md = md.receive_ts.max()
+    assert all(update.receive_ts <= last_md + latency + md_latency for update in updates), "run doesn't end with md!"
+
+    exchange_ts = { order.order_id:order.exchange_ts for order in orders }
+    late = [ trade.exchange_ts for trade in scan if trade.exchange_ts > exchange_ts[trade.order_id] + hold_time ]
+    end = min(late, default=np.inf)
+    key = lambda trade: (trade.order_id, trade.exchange_ts, trade.side, trade.size, trade.price, trade.execute)
+    assert [ key(trade) for trade in scan if trade.exchange_ts < end ] == \
+           [ key(trade) for trade in expire if trade.exchange_ts < end ], "expiration differs from cancel scan!"
+    return {'md_events': len(md), 'scan_trades': len(scan), 'expire_trades': len(expire), 'late_fills': len(late),
+            'scan_seconds': scan_seconds, 'expire_seconds': expire_seconds}
+
+
+def bench_events(md, n_runs:int = 3, n_events:int = 10**6) -> Dict[str, float]:
+    '''
+        This function measures construction, side comparison and memory of OwnTrade records:
+        slotted OwnTrade with Side/Execution codes, the same with validation (utils.set_debug)
+        and plain dataclass with __dict__ and string sides validated in __post_init__ as OwnTrade was before
+
+        Returns:
+            res(Dict[str, float]): seconds to construct and compare n_events records and bytes per record
+    '''
+    def post_init(self):
+        assert isinstance(self.side, str)
+    Plain = dataclasses.make_dataclass('OwnTrade', [ (f.name, f.type) for f in dataclasses.fields(OwnTrade) ],
+                                       namespace={'__post_init__': post_init})
+
+    def make(cls, bid, ask, book) -> List:
+        return [ cls(i, i, i, i, i, bid if i & 1 else ask, 0.001, 20000.0, book) for i in range(n_events) ]
+
+    def memory(cls, *codes) -> float:
+        tracemalloc.start()
+        events = make(cls, *codes)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / len(events)
+
+    res = {'events': n_events}
+    debug = utils.DEBUG
+    codes, strings = (BID, ASK, BOOK), ('BID', 'ASK', 'BOOK')
+    for name, cls, flag, (bid, ask, book) in [('slots', OwnTrade, False, codes), ('slots_debug', OwnTrade, True, codes),
+                                              ('dict', Plain, False, strings)]:
+        utils.set_debug(flag)
+        events = []
+        res[f'{name}_construct_seconds'] = _best_time(lambda: events.append(make(cls, bid, ask, book)), n_runs)
+        events = events[-1]
+        res[f'{name}_compare_seconds'] = _best_time(lambda: sum(1 for e in events if e.side == BID), n_runs)
+        res[f'{name}_bytes'] = memory(cls, bid, ask, book)
+    utils.set_debug(debug)
+    return res
+
+
+def bench_stream(path:str, T:int, n_runs:int = 3, chunksize:int = 1000) -> Dict[str, float]:
+    '''
+        This function compares stream_md_from_file with small chunks to the list-based path,
+        files are read in order of receive_ts, so exchange_ts goes out of order across chunks
+
+        Returns:
+            res(Dict[str, float]): time in seconds of both paths
+    '''
+    results = {}
+    def run_list():
+        results['list'] = merge_books_and_trades(load_books(path, T), load_trades(path, T))
+    def run_stream():
+        results['stream'] = list(stream_md_from_file(path, T, chunksize=chunksize))
+
+    list_seconds = _best_time(run_list, n_runs)
+    stream_seconds = _best_time(run_stream, n_runs)
+    assert results['stream'] == results['list'], "stream_md_from_file differs from the list-based path!"
+    return {'md_events': len(results['list']), 'chunksize': chunksize,
+            'list_seconds': list_seconds, 'stream_seconds': stream_seconds}
+
+
+BENCHMARKS = {
+    'sim': bench_sim,
+    'backtest': bench_backtest,
+    'pnl': bench_pnl,
+    'expire': bench_expire,
+    'events': bench_events,
+}
+
+
+#benchmarks that read files themselves, called with path and T
+FILE_BENCHMARKS = {
+    'stream': bench_stream,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='simulator benchmarks')
+    parser.add_argument('name', choices=sorted(list(BENCHMARKS) + list(FILE_BENCHMARKS)))
+    parser.add_argument('--path', default='../md/btcusdt:Binance:LinearPerpetual/')
+    parser.add_argument('--minutes', type=float, default=10.0)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    T = pd.Timedelta(args.minutes, 'm').value
+    if args.name in FILE_BENCHMARKS:
+        res = FILE_BENCHMARKS[args.name](args.path, T, n_runs=args.runs)
+    else:
+        md = load_md_from_file(args.path, T)
+        res = BENCHMARKS[args.name](md, n_runs=args.runs)
+    for k, v in res.items():
+        print(f"{k:>20}: {v:,.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,24 @@
-from typing import List, Union
+from typing import List, Optional, Union
 
 import numpy as np
 import pandas as pd
 
-from simulator import MdUpdate, OwnTrade, update_best_positions
+from simulator import MdUpdate, OwnTrade, BID, ASK, update_best_positions
+from market_data import MarketData, SIDE_CODES, forward_best_positions
 
 
-def get_pnl(updates_list:List[ Union[MdUpdate, OwnTrade] ], cost=-0.00001) -> pd.DataFrame:
+def get_pnl(updates_list:List[ Union[MdUpdate, OwnTrade] ], cost=-0.00001, md:Optional[MarketData] = None) -> pd.DataFrame:
     '''
         This function calculates PnL from list of updates
+
+        Args:
+            updates_list(List[Union[MdUpdate, OwnTrade]]): updates received by strategy
+            cost(float): fee per unit of traded notional
+            md(Optional[MarketData]): columnar market data. If given, only OwnTrade updates
+                                      are taken from updates_list and prices are taken from md
     '''
+    if not md is None:
+        return _get_pnl_md(updates_list, md, cost)
 
     #current position in btc and usd
     btc_pos, usd_pos = 0.0, 0.0
@@ -34,10 +43,10 @@ def get_pnl(updates_list:List[ Union[MdUpdate, OwnTrade] ], cost=-0.00001) -> pd
         if isinstance(update, OwnTrade):
             trade = update    
             #update positions
-            if trade.side == 'BID':
+            if trade.side == BID:
                 btc_pos += trade.size
                 usd_pos -= trade.price * trade.size
-            elif trade.side == 'ASK':
+            elif trade.side == ASK:
                 btc_pos -= trade.size
                 usd_pos += trade.price * trade.size
             usd_pos -= cost * trade.price * trade.size
@@ -57,12 +66,112 @@ def get_pnl(updates_list:List[ Union[MdUpdate, OwnTrade] ], cost=-0.00001) -> pd
     return df
 
 
+def _get_pnl_md(updates_list:List[ Union[MdUpdate, OwnTrade] ], md:MarketData, cost:float) -> pd.DataFrame:
+    '''
+        get_pnl for columnar market data, rows are md events in receive order merged with own trades
+    '''
+    trades = [update for update in updates_list if isinstance(update, OwnTrade)]
+
+    #market data in order of receiving
+    order = np.argsort(md.receive_ts, kind='stable')
+    best_bid, best_ask = md.best_positions(order)
+
+    trade_receive_ts = np.asarray([trade.receive_ts for trade in trades], dtype=np.int64)
+    trade_exchange_ts = np.asarray([trade.exchange_ts for trade in trades], dtype=np.int64)
+    side = np.asarray([trade.side for trade in trades])
+    size = np.asarray([trade.size for trade in trades], dtype=np.float64)
+    price = np.asarray([trade.price for trade in trades], dtype=np.float64)
+
+    return get_pnl_arrays(trade_receive_ts, side, size, price, md.receive_ts[order], best_bid, best_ask, cost,
+                          trade_exchange_ts, md.exchange_ts[order])
+
+
+def get_pnl_arrays(trade_receive_ts:np.ndarray, side:np.ndarray, size:np.ndarray, price:np.ndarray,
+                   md_receive_ts:np.ndarray, best_bid:np.ndarray, best_ask:np.ndarray, cost=-0.00001,
+                   trade_exchange_ts:Optional[np.ndarray] = None, md_exchange_ts:Optional[np.ndarray] = None) -> pd.DataFrame:
+    '''
+        Vectorized get_pnl: positions are cumulative sums of signed sizes and cash flows,
+        trades are marked to mid price of the last md received before them (as-of join).
+
+        Args:
+            trade_receive_ts(np.ndarray): receive timestamps of own trades, non-decreasing
+            side(np.ndarray): sides of own trades, 'BID'/'ASK' or 1/-1
+            size(np.ndarray): sizes of own trades
+            price(np.ndarray): prices of own trades
+            md_receive_ts(np.ndarray): receive timestamps of md, non-decreasing
+            best_bid(np.ndarray): best bid after each md
+            best_ask(np.ndarray): best ask after each md
+            cost(float): fee per unit of traded notional
+            trade_exchange_ts(Optional[np.ndarray]): exchange timestamps of own trades, receive timestamps by default
+            md_exchange_ts(Optional[np.ndarray]): exchange timestamps of md, receive timestamps by default
+        Returns:
+            df(pd.DataFrame): same columns as get_pnl, md rows merged with trade rows,
+                              trade goes after md with the same receive_ts
+    '''
+    trade_receive_ts = np.asarray(trade_receive_ts, dtype=np.int64)
+    md_receive_ts = np.asarray(md_receive_ts, dtype=np.int64)
+    side = np.asarray(side)
+    if side.dtype.kind in 'UO':
+        sgn = np.where(side == 'BID', 1.0, -1.0)
+    else:
+        sgn = np.sign(side).astype(np.float64)
+    notional = np.asarray(price, dtype=np.float64) * np.asarray(size, dtype=np.float64)
+    if trade_exchange_ts is None:
+        trade_exchange_ts = trade_receive_ts
+    if md_exchange_ts is None:
+        md_exchange_ts = md_receive_ts
+
+    #position of md and trades rows in the merged table
+    n_md, n_trades = len(md_receive_ts), len(trade_receive_ts)
+    N = n_md + n_trades
+    #number of md received before the trade (inclusive of equal receive_ts)
+    n_md_before = np.searchsorted(md_receive_ts, trade_receive_ts, side='right')
+    md_pos = np.arange(n_md) + np.searchsorted(trade_receive_ts, md_receive_ts, side='left')
+    trade_pos = np.arange(n_trades) + n_md_before
+
+    receive_ts = np.empty((N, ), dtype=np.int64)
+    exchange_ts = np.empty((N, ), dtype=np.int64)
+    receive_ts[md_pos], receive_ts[trade_pos] = md_receive_ts, trade_receive_ts
+    exchange_ts[md_pos], exchange_ts[trade_pos] = md_exchange_ts, trade_exchange_ts
+
+    btc_pos_arr = np.zeros((N, ))
+    usd_pos_arr = np.zeros((N, ))
+    btc_pos_arr[trade_pos] = sgn * size
+    usd_pos_arr[trade_pos] = -sgn * notional - cost * notional
+    btc_pos_arr = np.cumsum(btc_pos_arr)
+    usd_pos_arr = np.cumsum(usd_pos_arr)
+
+    #mid price of md rows, trade rows take mid price of the last received md
+    mid_price_arr = np.empty((N, ))
+    with np.errstate(invalid='ignore'):
+        md_mid = 0.5 * ( np.asarray(best_ask) + np.asarray(best_bid) )
+    mid_price_arr[md_pos] = md_mid
+    mid_price_arr[trade_pos] = np.append(np.nan, md_mid)[n_md_before]
+
+    worth_arr = btc_pos_arr * mid_price_arr + usd_pos_arr
+
+    df = pd.DataFrame({"exchange_ts": exchange_ts, "receive_ts":receive_ts, "total":worth_arr, "BTC":btc_pos_arr,
+                       "USD":usd_pos_arr, "mid_price":mid_price_arr})
+    return df
+
+
+def _last_by_receive_ts(df:pd.DataFrame) -> pd.DataFrame:
+    '''
+        keeps the last row of each receive_ts, rows are sorted by receive_ts, receive_ts is the first column
+        (same as groupby('receive_ts').agg(lambda x: x.iloc[-1]).reset_index())
+    '''
+    df = df.drop_duplicates('receive_ts', keep='last')
+    df = df.sort_values('receive_ts', kind='stable')
+    columns = ['receive_ts'] + [c for c in df.columns if c != 'receive_ts']
+    return df[columns].reset_index(drop=True)
+
+
 def trade_to_dataframe(trades_list:List[OwnTrade]) -> pd.DataFrame:
-    exchange_ts = [ trade.exchange_ts for trade in trades_list ]
-    receive_ts = [ trade.receive_ts for trade in trades_list ]
+    exchange_ts = np.fromiter( (trade.exchange_ts for trade in trades_list), dtype=np.int64, count=len(trades_list) )
+    receive_ts = np.fromiter( (trade.receive_ts for trade in trades_list), dtype=np.int64, count=len(trades_list) )
     
-    size = [ trade.size for trade in trades_list ]
-    price = [ trade.price for trade in trades_list ]
+    size = np.fromiter( (trade.size for trade in trades_list), dtype=np.float64, count=len(trades_list) )
+    price = np.fromiter( (trade.price for trade in trades_list), dtype=np.float64, count=len(trades_list) )
     side  = [trade.side for trade in trades_list ]
     
     dct = {
@@ -73,24 +182,36 @@ def trade_to_dataframe(trades_list:List[OwnTrade]) -> pd.DataFrame:
         "side"  : side
     }
 
-    df = pd.DataFrame(dct).groupby('receive_ts').agg(lambda x: x.iloc[-1]).reset_index()    
-    return df
+    return _last_by_receive_ts(pd.DataFrame(dct))
 
 
-def md_to_dataframe(md_list: List[MdUpdate]) -> pd.DataFrame:
-    
-    best_bid = -np.inf
-    best_ask = np.inf
-    best_bids = []
-    best_asks = []
-    for md in md_list:
-        best_bid, best_ask = update_best_positions(best_bid, best_ask, md)
-        
-        best_bids.append(best_bid)
-        best_asks.append(best_ask)
-        
-    exchange_ts = [ md.exchange_ts for md in md_list ]
-    receive_ts = [ md.receive_ts for md in md_list ]
+def md_to_dataframe(md_list: Union[List[MdUpdate], MarketData]) -> pd.DataFrame:
+    '''
+        This function calculates best positions after each md, the last md of each receive_ts is kept
+
+        Args:
+            md_list(Union[List[MdUpdate], MarketData]): md received by strategy or columnar md,
+                                                      columnar md is taken in order of receiving
+    '''
+    if isinstance(md_list, MarketData):
+        order = np.argsort(md_list.receive_ts, kind='stable')
+        best_bids, best_asks = md_list.best_positions(order)
+        exchange_ts, receive_ts = md_list.exchange_ts[order], md_list.receive_ts[order]
+    else:
+        N = len(md_list)
+        has_book = np.fromiter( (not md.orderbook is None for md in md_list), dtype=bool, count=N )
+        book_bid = np.fromiter( (md.orderbook.bids[0][0] if not md.orderbook is None else np.nan for md in md_list),
+                                dtype=np.float64, count=N )
+        book_ask = np.fromiter( (md.orderbook.asks[0][0] if not md.orderbook is None else np.nan for md in md_list),
+                                dtype=np.float64, count=N )
+        trade_side = np.fromiter( (SIDE_CODES[md.trade.side] if not md.trade is None else 0 for md in md_list),
+                                  dtype=np.int8, count=N )
+        trade_price = np.fromiter( (md.trade.price if not md.trade is None else np.nan for md in md_list),
+                                   dtype=np.float64, count=N )
+        best_bids, best_asks = forward_best_positions(has_book, book_bid, book_ask, trade_side, trade_price)
+
+        exchange_ts = np.fromiter( (md.exchange_ts for md in md_list), dtype=np.int64, count=N )
+        receive_ts = np.fromiter( (md.receive_ts for md in md_list), dtype=np.int64, count=N )
     dct = {
         "exchange_ts" : exchange_ts,
         "receive_ts"  :receive_ts,
@@ -98,5 +219,4 @@ def md_to_dataframe(md_list: List[MdUpdate]) -> pd.DataFrame:
         "ask_price" : best_asks
     }
     
-    df = pd.DataFrame(dct).groupby('receive_ts').agg(lambda x: x.iloc[-1]).reset_index()    
-    return df
\ No newline at end of file
+    return _last_by_receive_ts(pd.DataFrame(dct))
@@ -1,24 +1,35 @@
-from typing import List
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
 from simulator import AnonTrade, MdUpdate, OrderbookSnapshotUpdate
+from market_data import BookColumns, TradeColumns, MarketData, merge_md_columns, sort_by_key, SIDE_CODES, SIDE_NAMES
 
 
-def load_before_time(path, T):
-    chunksize = 10 ** 5
-    chunks = []
+#fields of orderbook level columns
+BOOK_FIELDS = ['ask_price', 'ask_vol', 'bid_price', 'bid_vol']
+
+
+def iter_before_time(path, T, usecols=None, chunksize=10 ** 5) -> Iterator[pd.DataFrame]:
+    '''
+        This function reads csv file by chunks and yields rows with receive_ts
+        less than T nanoseconds after the first one
+    '''
     t0 = None
-    for chunk in pd.read_csv(path, chunksize=chunksize):
+    for chunk in pd.read_csv(path, chunksize=chunksize, usecols=usecols):
         if t0 is None:
             t0 = chunk['receive_ts'].iloc[0]
-        chunks.append(chunk)
+        yield chunk.loc[chunk['receive_ts'] - t0 < T]
         if chunk['receive_ts'].iloc[-1] - t0 >= T:
             break
-    df = pd.concat(chunks)
-    mask = df['receive_ts'] - df['receive_ts'].iloc[0] < T
-    df = df.loc[mask]
 
+
+def load_before_time(path, T, usecols=None):
+    df = pd.concat(list(iter_before_time(path, T, usecols)))
     return df
 
 def load_trades(path:str, T:int) -> List[AnonTrade]:
@@ -36,65 +47,314 @@ def load_trades(path:str, T:int) -> List[AnonTrade]:
     
     #переставляю колонки, чтобы удобнее подавать их в конструктор AnonTrade
     trades = trades[ ['exchange_ts', 'receive_ts', 'aggro_side', 'size', 'price' ] ].sort_values(["exchange_ts", 'receive_ts'])
-    receive_ts = trades.receive_ts.values
-    exchange_ts = trades.exchange_ts.values 
-    trades = [ AnonTrade(*args) for args in trades.values]
-    return trades
+    #sides are converted to Side codes
+    return _trade_objects(_trade_columns(trades))
 
 
-def load_books(path:str, T:int) -> List[OrderbookSnapshotUpdate]:
+def load_books(path:str, T:int, depth:int = 10) -> List[OrderbookSnapshotUpdate]:
     '''
         This function downloads orderbook market data
 
         Args:
             path(str): path to file
             T(int): max timestamp from the first one in nanoseconds
+            depth(int): number of orderbook levels to load
 
         Return:
             books(List[OrderbookSnapshotUpdate]): list of orderbooks snapshots 
     '''
-    lobs   = load_before_time(path + 'lobs.csv', T)
-    
-    #rename columns
-    names = lobs.columns.values
+    return _book_objects(load_book_columns(path, T, depth, cache=False))
+
+
+#directory for binary copies of csv files, created next to the csv files
+CACHE_DIR = '.cache'
+
+
+def _load_cached_columns(csv_path:str, build:Callable[[], Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    '''
+        This function loads columns of csv file from the binary cache.
+        On the first call `build` is called and its result is saved as .npy files.
+        The cache is keyed on the size and mtime of the csv file.
+
+        Args:
+            csv_path(str): path to csv file
+            build(Callable[[], Dict[str, np.ndarray]]): function that parses csv file into columns
+
+        Return:
+            columns(Dict[str, np.ndarray]): read-only memory-mapped columns
+    '''
+    head, name = os.path.split(csv_path)
+    stat = os.stat(csv_path)
+    root = os.path.join(head, CACHE_DIR)
+    cache_dir = os.path.join(root, f"{name}-{stat.st_size}-{stat.st_mtime_ns}")
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(root, exist_ok=True)
+        #write to temporary directory first, so interrupted conversion is never used
+        tmp_dir = tempfile.mkdtemp(dir=root)
+        for key, column in build().items():
+            np.save(os.path.join(tmp_dir, key + '.npy'), column)
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            #another process has built the same cache, it is reused
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(cache_dir):
+                raise
+        #delete outdated caches of the same file, current cache is kept
+        current = os.path.basename(cache_dir)
+        for old in os.listdir(root):
+            if old.startswith(name + '-') and old != current:
+                shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+    return { fname[:-len('.npy')] : np.load(os.path.join(cache_dir, fname), mmap_mode='r')
+             for fname in os.listdir(cache_dir) if fname.endswith('.npy') }
+
+
+def _time_window(receive_ts:np.ndarray, T:int) -> Union[slice, np.ndarray]:
+    '''
+        rows with receive_ts less than T nanoseconds after the first one, same as in load_before_time
+    '''
+    if len(receive_ts) == 0:
+        return slice(0, 0)
+    t_max = receive_ts[0] + T
+    if np.all(receive_ts[1:] >= receive_ts[:-1]):
+        return slice(0, np.searchsorted(receive_ts, t_max, side='left'))
+    return np.flatnonzero(receive_ts < t_max)
+
+
+def _trade_columns(trades:pd.DataFrame) -> TradeColumns:
+    side = trades['aggro_side'].map(SIDE_CODES)
+    assert not side.isna().any(), "WRONG TRADE SIDE"
+
+    return TradeColumns(
+        trades['exchange_ts'].values.astype(np.int64),
+        trades['receive_ts'].values.astype(np.int64),
+        side.values.astype(np.int8),
+        trades['size'].values.astype(np.float64),
+        trades['price'].values.astype(np.float64))
+
+
+def load_trade_columns(path:str, T:int, cache:bool = True) -> TradeColumns:
+    '''
+        This function downloads trades data into numpy arrays
+
+        Args:
+            path(str): path to file
+            T(int): max timestamp from the first one in nanoseconds
+            cache(bool): if True, trades are memory-mapped from the binary cache
+
+        Return:
+            trades(TradeColumns): columnar trades sorted by (exchange_ts, receive_ts)
+    '''
+    if cache:
+        build = lambda: vars( _trade_columns(load_before_time(path + 'trades.csv', np.inf)) )
+        columns = _load_cached_columns(path + 'trades.csv', build)
+        window = _time_window(columns['receive_ts'], T)
+        trades = TradeColumns(**{ k:v[window] for k, v in columns.items() })
+    else:
+        trades = _trade_columns(load_before_time(path + 'trades.csv', T))
+
+    return sort_by_key(trades)
+
+
+def _lobs_columns(path:str, depth:Optional[int]) -> Tuple[List[str], List[str]]:
+    '''
+        Returns:
+            ts_names(List[str]): names of timestamp columns, [receive_ts, exchange_ts]
+            level_names(List[str]): names of level columns grouped by field,
+                                    ask_price_0, ..., ask_price_{depth-1}, ask_vol_0, ...
+    '''
+    #full column names, e.g. btcusdt:Binance:LinearPerpetual_ask_price_0
+    names = pd.read_csv(path + 'lobs.csv', nrows=0).columns.values
     ln = len('btcusdt:Binance:LinearPerpetual_')
-    renamer = { name:name[ln:] for name in names[2:]}
-    renamer[' exchange_ts'] = 'exchange_ts'
-    lobs.rename(renamer, axis=1, inplace=True)
-    
-    #timestamps
-    receive_ts = lobs.receive_ts.values
-    exchange_ts = lobs.exchange_ts.values 
-    #список ask_price, ask_vol для разных уровней стакана
-    #размеры: len(asks) = 10, len(asks[0]) = len(lobs)
-    asks = [list(zip(lobs[f"ask_price_{i}"],lobs[f"ask_vol_{i}"])) for i in range(10)]
-    #транспонируем список
-    asks = [ [asks[i][j] for i in range(len(asks))] for j in range(len(asks[0]))]
-    #тоже самое с бидами
-    bids = [list(zip(lobs[f"bid_price_{i}"],lobs[f"bid_vol_{i}"])) for i in range(10)]
-    bids = [ [bids[i][j] for i in range(len(bids))] for j in range(len(bids[0]))]
-    
-    books = list( OrderbookSnapshotUpdate(*args) for args in zip(exchange_ts, receive_ts, asks, bids) )
-    return books
+    columns = { name[ln:]:name for name in names[2:] }
+    if depth is None:
+        depth = sum(name.startswith('ask_price_') for name in columns)
+    level_names = [ columns[f"{field}_{i}"] for field in BOOK_FIELDS for i in range(depth) ]
+    return list(names[:2]), level_names
+
+
+def _book_frame_columns(lobs:pd.DataFrame, ts_names:List[str], level_names:List[str]) -> BookColumns:
+    depth = len(level_names) // len(BOOK_FIELDS)
+    #(N, 4 * depth) -> (N, 4, depth), one slice for every field
+    levels = lobs[level_names].to_numpy(dtype=np.float64).reshape(len(lobs), len(BOOK_FIELDS), depth)
+    ask_price, ask_vol, bid_price, bid_vol = [ np.ascontiguousarray(levels[:, k]) for k in range(len(BOOK_FIELDS)) ]
+
+    return BookColumns(
+        lobs[ts_names[1]].values.astype(np.int64),
+        lobs[ts_names[0]].values.astype(np.int64),
+        ask_price, ask_vol, bid_price, bid_vol)
+
+
+def _book_columns(path:str, T:int, depth:Optional[int]) -> BookColumns:
+    ts_names, level_names = _lobs_columns(path, depth)
+    lobs = load_before_time(path + 'lobs.csv', T, usecols=ts_names + level_names)
+    return _book_frame_columns(lobs, ts_names, level_names)
+
+
+def _book_objects(books:BookColumns) -> List[OrderbookSnapshotUpdate]:
+    #rows of (depth, ) arrays -> lists of (price, size) tuples
+    asks = [ list(zip(p, v)) for p, v in zip(books.ask_price.tolist(), books.ask_vol.tolist()) ]
+    bids = [ list(zip(p, v)) for p, v in zip(books.bid_price.tolist(), books.bid_vol.tolist()) ]
+
+    exchange_ts = books.exchange_ts.tolist()
+    receive_ts = books.receive_ts.tolist()
+    return list( OrderbookSnapshotUpdate(*args) for args in zip(exchange_ts, receive_ts, asks, bids) )
+
+
+def _trade_objects(trades:TradeColumns) -> List[AnonTrade]:
+    side = [ SIDE_NAMES[s] for s in trades.side.tolist() ]
+    return [ AnonTrade(*args) for args in zip(trades.exchange_ts.tolist(), trades.receive_ts.tolist(), side,
+                                              trades.size.tolist(), trades.price.tolist()) ]
+
+
+def load_book_columns(path:str, T:int, depth:int = 10, cache:bool = True) -> BookColumns:
+    '''
+        This function downloads orderbook market data into numpy arrays.
+        Only the first `depth` levels are read from the file.
+
+        Args:
+            path(str): path to file
+            T(int): max timestamp from the first one in nanoseconds
+            depth(int): number of orderbook levels to load
+            cache(bool): if True, snapshots are memory-mapped from the binary cache,
+                         the cache keeps all the levels of the file
+
+        Return:
+            books(BookColumns): columnar orderbook snapshots, levels have shape (N, depth)
+    '''
+    if not cache:
+        return _book_columns(path, T, depth)
+
+    build = lambda: vars( _book_columns(path, np.inf, None) )
+    columns = _load_cached_columns(path + 'lobs.csv', build)
+    n_levels = columns['ask_price'].shape[1]
+    if depth > n_levels:
+        raise ValueError(f"depth {depth} is larger than number of levels in the file: {n_levels}")
+    window = _time_window(columns['receive_ts'], T)
+    books = { k:(v[window] if v.ndim == 1 else v[window, :depth]) for k, v in columns.items() }
+    return BookColumns(**books)
+
+
+def _is_sorted_by_key(rows:List[Union[OrderbookSnapshotUpdate, AnonTrade]]) -> bool:
+    return all( (a.exchange_ts, a.receive_ts) <= (b.exchange_ts, b.receive_ts) for a, b in zip(rows, rows[1:]) )
 
 
 def merge_books_and_trades(books : List[OrderbookSnapshotUpdate], trades: List[AnonTrade]) -> List[MdUpdate]:
     '''
         This function merges lists of orderbook snapshots and trades 
+        with a linear merge, lists are sorted only if they are not sorted by (exchange_ts, receive_ts)
     '''
-    trades_dict = { (trade.exchange_ts, trade.receive_ts) : trade for trade in trades }
-    books_dict  = { (book.exchange_ts, book.receive_ts) : book for book in books }
-    
-    ts = sorted(trades_dict.keys() | books_dict.keys())
+    key = lambda x: (x.exchange_ts, x.receive_ts)
+    if not _is_sorted_by_key(books):
+        books = sorted(books, key=key)
+    if not _is_sorted_by_key(trades):
+        trades = sorted(trades, key=key)
+    return list(iter_merge_books_and_trades(books, trades))
 
-    md = [MdUpdate(*key, books_dict.get(key, None), trades_dict.get(key, None)) for key in ts]
-    return md
 
+def iter_merge_books_and_trades(books:Iterable[OrderbookSnapshotUpdate],
+                                trades:Iterable[AnonTrade]) -> Iterator[MdUpdate]:
+    '''
+        This function lazily merges streams of orderbook snapshots and trades
+        sorted by (exchange_ts, receive_ts), ValueError is raised if a stream is not sorted.
 
-def load_md_from_file(path: str, T:int) -> List[MdUpdate]:
+        Same as merge_md_columns: all the trades are kept, trades go before snapshots with the same key,
+        the first snapshot with a key is merged into one MdUpdate with the last trade with the same key.
+    '''
+    key = lambda x: (x.exchange_ts, x.receive_ts)
+
+    def pull(it, prev):
+        row = next(it, None)
+        if not row is None and not prev is None and key(row) < key(prev):
+            raise ValueError(f"market data is not sorted by (exchange_ts, receive_ts): {key(row)} after {key(prev)}")
+        return row
+
+    books, trades = iter(books), iter(trades)
+    book, trade = pull(books, None), pull(trades, None)
+    while not (book is None and trade is None):
+        if not trade is None and (book is None or key(trade) <= key(book)):
+            cur, trade = trade, pull(trades, trade)
+            last_trade = trade is None or key(trade) != key(cur)
+            if last_trade and not book is None and key(book) == key(cur):
+                yield MdUpdate(*key(cur), book, cur)
+                book = pull(books, book)
+            else:
+                yield MdUpdate(*key(cur), None, cur)
+        else:
+            yield MdUpdate(*key(book), book, None)
+            book = pull(books, book)
+
+
+def _iter_sorted_columns(chunks:Iterable[pd.DataFrame],
+                         to_columns:Callable[[pd.DataFrame], Union[BookColumns, TradeColumns]],
+                         max_delay:int) -> Iterator[Union[BookColumns, TradeColumns]]:
+    '''
+        This function sorts chunks of rows written in order of receive_ts by (exchange_ts, receive_ts).
+        Row is held until receive_ts of the read rows passes its exchange_ts + max_delay,
+        so the held tail is bounded by the rows received within max_delay.
+    '''
+    tail = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        columns = to_columns(chunk)
+        if not tail is None:
+            columns = type(columns)(**{ k:np.concatenate([v, getattr(columns, k)]) for k, v in vars(tail).items() })
+        columns = sort_by_key(columns)
+        #rows read later have exchange_ts >= receive_ts - max_delay
+        n = np.searchsorted(columns.exchange_ts, chunk['receive_ts'].max() - max_delay, side='left')
+        yield type(columns)(**{ k:v[:n] for k, v in vars(columns).items() })
+        tail = type(columns)(**{ k:v[n:] for k, v in vars(columns).items() })
+    if not tail is None:
+        yield tail
+
+
+def stream_md_from_file(path: str, T:int = np.inf, depth:int = 10, chunksize:int = 10 ** 5,
+                        max_delay:int = 10 * 10 ** 9) -> Iterator[MdUpdate]:
+    '''
+        This function lazily reads orderbooks and trades by chunks and merges them.
+        Memory usage does not depend on T. Files are written in order of receive_ts,
+        rows are reordered by (exchange_ts, receive_ts) with a look-ahead of max_delay nanoseconds,
+        ValueError is raised if receive_ts - exchange_ts of a row exceeds max_delay and breaks the order.
+
+        Args:
+            path(str): path to directory with lobs.csv and trades.csv
+            T(int): max timestamp from the first one in nanoseconds
+            depth(int): number of orderbook levels to load
+            chunksize(int): number of rows in chunk
+            max_delay(int): max receive_ts - exchange_ts in nanoseconds
+
+        Return:
+            md(Iterator[MdUpdate]): market data, same as load_md_from_file
+    '''
+    ts_names, level_names = _lobs_columns(path, depth)
+    lobs = iter_before_time(path + 'lobs.csv', T, ts_names + level_names, chunksize)
+    to_books = lambda chunk: _book_frame_columns(chunk, ts_names, level_names)
+    books = ( book for columns in _iter_sorted_columns(lobs, to_books, max_delay)
+                   for book in _book_objects(columns) )
+
+    chunks = iter_before_time(path + 'trades.csv', T, chunksize=chunksize)
+    trades = ( trade for columns in _iter_sorted_columns(chunks, _trade_columns, max_delay)
+                     for trade in _trade_objects(columns) )
+    return iter_merge_books_and_trades(books, trades)
+
+
+def load_md_from_file(path: str, T:int, depth:int = 10, cache:bool = True) -> MarketData:
     '''
         This function downloads orderbooks ans trades and merges them
+
+        Args:
+            path(str): path to directory with lobs.csv and trades.csv
+            T(int): max timestamp from the first one in nanoseconds
+            depth(int): number of orderbook levels to load
+            cache(bool): if True, csv files are converted to binary cache once (in `path/.cache/`),
+                         later calls memory-map the cache instead of parsing csv
+
+        Return:
+            md(MarketData): columnar market data, MdUpdate objects are created on access
     '''
-    books  = load_books(path, T)
-    trades = load_trades(path, T)
-    return merge_books_and_trades(books, trades)
\ No newline at end of file
+    books  = load_book_columns(path, T, depth, cache)
+    trades = load_trade_columns(path, T, cache)
+    return merge_md_columns(books, trades)
\ No newline at end of file
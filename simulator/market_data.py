@@ -0,0 +1,370 @@
+from collections import abc, deque
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from utils import AnonTrade, MdUpdate, OrderbookSnapshotUpdate, BookRow, BID, ASK
+
+
+#trade side codes used in the columnar storage
+SIDE_CODES = {BID: 1, ASK: -1}
+SIDE_NAMES = {1: BID, -1: ASK}
+
+
+@dataclass
+class BookColumns:  # Orderbook snapshots, one row per snapshot
+    exchange_ts : np.ndarray # int64, shape (N, )
+    receive_ts  : np.ndarray # int64, shape (N, )
+    ask_price   : np.ndarray # float64, shape (N, depth)
+    ask_vol     : np.ndarray # float64, shape (N, depth)
+    bid_price   : np.ndarray # float64, shape (N, depth)
+    bid_vol     : np.ndarray # float64, shape (N, depth)
+
+
+    def __len__(self) -> int:
+        return len(self.exchange_ts)
+
+
+    @property
+    def depth(self) -> int:
+        return self.ask_price.shape[1]
+
+
+    def snapshot(self, i:int) -> BookRow:
+        '''
+            creates OrderbookSnapshotUpdate view of the i-th row, levels are read from the arrays on access
+        '''
+        return BookRow(self, i)
+
+
+@dataclass
+class TradeColumns:  # Market trades, one row per trade
+    exchange_ts : np.ndarray # int64, shape (M, )
+    receive_ts  : np.ndarray # int64, shape (M, )
+    side        : np.ndarray # int8, 1 for BID and -1 for ASK
+    size        : np.ndarray # float64
+    price       : np.ndarray # float64
+
+
+    def __len__(self) -> int:
+        return len(self.exchange_ts)
+
+
+    def trade(self, i:int) -> AnonTrade:
+        '''
+            creates AnonTrade view of the i-th row
+        '''
+        return AnonTrade(int(self.exchange_ts[i]), int(self.receive_ts[i]), SIDE_NAMES[int(self.side[i])],
+                         float(self.size[i]), float(self.price[i]))
+
+
+class MarketData:
+    '''
+        Columnar market data.
+
+        Books and trades are stored in separate tables, events are stored as
+        aligned arrays sorted by (exchange_ts, receive_ts), several events can have the same key.
+        Each event refers to a row of the books table and/or a row of the trades table (-1 if there is none).
+        MdUpdate objects are created only on access.
+    '''
+    def __init__(self, exchange_ts:np.ndarray, receive_ts:np.ndarray,
+                       book_idx:np.ndarray, trade_idx:np.ndarray,
+                       books:BookColumns, trades:TradeColumns) -> None:
+        '''
+            Args:
+                exchange_ts(np.ndarray): int64 exchange timestamps of the events
+                receive_ts(np.ndarray): int64 receive timestamps of the events
+                book_idx(np.ndarray): index of the orderbook snapshot of the event or -1
+                trade_idx(np.ndarray): index of the trade of the event or -1
+                books(BookColumns): orderbook snapshots
+                trades(TradeColumns): trades
+        '''
+        self.exchange_ts = exchange_ts
+        self.receive_ts  = receive_ts
+        self.book_idx    = book_idx
+        self.trade_idx   = trade_idx
+        self.books  = books
+        self.trades = trades
+
+
+    def __len__(self) -> int:
+        return len(self.exchange_ts)
+
+
+    def __getitem__(self, i:Union[int, slice]) -> Union[MdUpdate, 'MarketData']:
+        if isinstance(i, slice):
+            return MarketData(self.exchange_ts[i], self.receive_ts[i], self.book_idx[i], self.trade_idx[i],
+                              self.books, self.trades)
+        b, t = self.book_idx[i], self.trade_idx[i]
+        book  = self.books.snapshot(b) if b >= 0 else None
+        trade = self.trades.trade(t) if t >= 0 else None
+        return MdUpdate(int(self.exchange_ts[i]), int(self.receive_ts[i]), book, trade)
+
+
+    def __iter__(self) -> Iterator[MdUpdate]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def best_positions(self, order:Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+            Vectorized version of update_best_positions applied to all the events
+
+            Args:
+                order(Optional[np.ndarray]): order of the events, exchange order by default
+            Returns:
+                best_bid(np.ndarray), best_ask(np.ndarray): best positions after each event
+        '''
+        book_idx, trade_idx = self.book_idx, self.trade_idx
+        if not order is None:
+            book_idx, trade_idx = book_idx[order], trade_idx[order]
+
+        has_book  = book_idx >= 0
+        has_trade = (trade_idx >= 0) & ~has_book
+
+        bid = np.full(len(book_idx), np.nan)
+        ask = np.full(len(book_idx), np.nan)
+        bid[has_book] = self.books.bid_price[book_idx[has_book], 0]
+        ask[has_book] = self.books.ask_price[book_idx[has_book], 0]
+
+        trade_side  = np.zeros(len(book_idx), dtype=np.int8)
+        trade_price = np.zeros(len(book_idx))
+        trade_side[has_trade]  = self.trades.side[trade_idx[has_trade]]
+        trade_price[has_trade] = self.trades.price[trade_idx[has_trade]]
+        return forward_best_positions(has_book, bid, ask, trade_side, trade_price)
+
+
+def forward_best_positions(has_book:np.ndarray, book_bid:np.ndarray, book_ask:np.ndarray,
+                           trade_side:np.ndarray, trade_price:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+        Vectorized update_best_positions over a sequence of events:
+        best positions are taken from the last orderbook snapshot and moved by the trades after it
+
+        Args:
+            has_book(np.ndarray): True for events with orderbook snapshot
+            book_bid(np.ndarray): best bid of the snapshot, used where has_book
+            book_ask(np.ndarray): best ask of the snapshot, used where has_book
+            trade_side(np.ndarray): 1 for BID trade, -1 for ASK trade, 0 if event has no trade, used where not has_book
+            trade_price(np.ndarray): price of the trade
+        Returns:
+            best_bid(np.ndarray), best_ask(np.ndarray): best positions after each event
+    '''
+    has_book = np.asarray(has_book, dtype=bool)
+    trade_side = np.where(has_book, 0, trade_side)
+    #segments between orderbook snapshots, segment 0 is before the first snapshot
+    segment = np.cumsum(has_book)
+
+    #trades on BID side can only increase best ask, trades on ASK side can only decrease best bid
+    ask = np.full(len(has_book), -np.inf)
+    ask[has_book] = book_ask[has_book]
+    bid_trades = trade_side == 1
+    ask[bid_trades] = trade_price[bid_trades]
+    ask = pd.Series(ask).groupby(segment).cummax().to_numpy(copy=True)
+    ask[segment == 0] = np.inf
+
+    bid = np.full(len(has_book), np.inf)
+    bid[has_book] = book_bid[has_book]
+    ask_trades = trade_side == -1
+    bid[ask_trades] = trade_price[ask_trades]
+    bid = pd.Series(bid).groupby(segment).cummin().to_numpy(copy=True)
+    bid[segment == 0] = -np.inf
+    return bid, ask
+
+
+def key_order(columns:Union[BookColumns, TradeColumns]) -> Optional[np.ndarray]:
+    '''
+        Returns:
+            order(Optional[np.ndarray]): order of rows by (exchange_ts, receive_ts), None if rows are already sorted
+    '''
+    exchange_ts, receive_ts = columns.exchange_ts, columns.receive_ts
+    is_sorted = np.all( (exchange_ts[1:] > exchange_ts[:-1]) |
+                        ((exchange_ts[1:] == exchange_ts[:-1]) & (receive_ts[1:] >= receive_ts[:-1])) )
+    return None if is_sorted else np.lexsort((receive_ts, exchange_ts))
+
+
+def sort_by_key(columns:Union[BookColumns, TradeColumns]) -> Union[BookColumns, TradeColumns]:
+    '''
+        sorts rows by (exchange_ts, receive_ts), the copy is made only if rows are not sorted
+    '''
+    order = key_order(columns)
+    if order is None:
+        return columns
+    return type(columns)(**{ k:v[order] for k, v in vars(columns).items() })
+
+
+def combined_keys(exchange_ts:np.ndarray, receive_ts:np.ndarray,
+                  e:np.ndarray, r:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+        Encodes keys (exchange_ts, receive_ts) of two tables into int64 keys with the same lexicographic order:
+        timestamps are replaced by their ranks among the keys of both tables, key = exchange_rank * K + receive_rank
+
+        Returns:
+            key(np.ndarray), key_er(np.ndarray): keys of (exchange_ts, receive_ts) and of (e, r)
+    '''
+    n = len(exchange_ts)
+    _, ex_rank = np.unique(np.concatenate([exchange_ts, e]), return_inverse=True)
+    _, rc_rank = np.unique(np.concatenate([receive_ts, r]), return_inverse=True)
+    key = ex_rank.astype(np.int64).reshape(-1) * (int(rc_rank.max(initial=0)) + 1) + rc_rank.reshape(-1)
+    return key[:n], key[n:]
+
+
+def searchsorted_key(exchange_ts:np.ndarray, receive_ts:np.ndarray,
+                     e:np.ndarray, r:np.ndarray, side:str = 'left') -> np.ndarray:
+    '''
+        np.searchsorted for keys (exchange_ts, receive_ts) sorted lexicographically,
+        one searchsorted over the combined keys
+
+        Returns:
+            pos(np.ndarray): number of rows with key < (e, r) for side='left', key <= (e, r) for side='right'
+    '''
+    key, key_er = combined_keys(exchange_ts, receive_ts, e, r)
+    return np.searchsorted(key, key_er, side=side)
+
+
+def merge_md_columns(books:BookColumns, trades:TradeColumns) -> MarketData:
+    '''
+        This function merges orderbook snapshots and trades by (exchange_ts, receive_ts)
+        by one searchsorted of combined keys per table, the tables are reordered only if they are not sorted.
+
+        All the trades are kept, trades go before snapshots with the same key.
+        The first snapshot with a key is merged into one event with the last trade with the same key,
+        so a key with one snapshot and one trade gives one event.
+    '''
+    book_order, trade_order = key_order(books), key_order(trades)
+    book_order  = np.arange(len(books)) if book_order is None else book_order
+    trade_order = np.arange(len(trades)) if trade_order is None else trade_order
+    book_ex, book_rc = books.exchange_ts[book_order], books.receive_ts[book_order]
+    trade_ex, trade_rc = trades.exchange_ts[trade_order], trades.receive_ts[trade_order]
+
+    #positions in the merged table
+    trade_key, book_key = combined_keys(trade_ex, trade_rc, book_ex, book_rc)
+    trades_before_book = np.searchsorted(trade_key, book_key, side='right')
+    book_pos  = np.arange(len(books)) + trades_before_book
+    trade_pos = np.arange(len(trades)) + np.searchsorted(book_key, trade_key, side='left')
+
+    N = len(books) + len(trades)
+    exchange_ts = np.empty((N, ), dtype=np.int64)
+    receive_ts  = np.empty((N, ), dtype=np.int64)
+    book_idx  = np.full((N, ), -1, dtype=np.int64)
+    trade_idx = np.full((N, ), -1, dtype=np.int64)
+    exchange_ts[book_pos], receive_ts[book_pos] = book_ex, book_rc
+    exchange_ts[trade_pos], receive_ts[trade_pos] = trade_ex, trade_rc
+    book_idx[book_pos] = book_order
+    trade_idx[trade_pos] = trade_order
+
+    #snapshot is merged with the previous row if it is a trade with the same key
+    prev = np.maximum(trades_before_book - 1, 0)
+    fuse = (trades_before_book > 0) & (book_idx[np.maximum(book_pos - 1, 0)] == -1)
+    if len(trades):
+        fuse &= (trade_ex[prev] == book_ex) & (trade_rc[prev] == book_rc)
+    fused_pos = book_pos[fuse]
+    trade_idx[fused_pos] = trade_idx[fused_pos - 1]
+    keep = np.ones((N, ), dtype=bool)
+    keep[fused_pos - 1] = False
+
+    return MarketData(exchange_ts[keep], receive_ts[keep], book_idx[keep], trade_idx[keep], books, trades)
+
+
+class MdQueue(deque):
+    '''
+        Queue of MdUpdate objects
+    '''
+    def head_ts(self) -> float:
+        return np.inf if len(self) == 0 else self[0].exchange_ts
+
+
+    def popleft_until(self, receive_ts:float) -> Optional[MdUpdate]:
+        '''
+            pops at least one update and keeps popping while receive_ts of the last popped one is less than `receive_ts`
+
+            Returns:
+                md(Optional[MdUpdate]): last popped update, None if the queue is empty
+        '''
+        md = None
+        while len(self) and (md is None or md.receive_ts < receive_ts):
+            md = self.popleft()
+        return md
+
+
+class MdArrayQueue:
+    '''
+        Queue over columnar market data, MdUpdate is created when it is popped
+    '''
+    def __init__(self, md:MarketData, order:Optional[np.ndarray] = None) -> None:
+        '''
+            Args:
+                md(MarketData): market data
+                order(Optional[np.ndarray]): order of the events, exchange order by default
+        '''
+        self._md = md
+        self._order = order
+        self._exchange_ts = md.exchange_ts if order is None else md.exchange_ts[order]
+        self._receive_ts  = md.receive_ts if order is None else md.receive_ts[order]
+        self._pos = 0
+
+
+    def __len__(self) -> int:
+        return len(self._md) - self._pos
+
+
+    def head_ts(self) -> float:
+        return np.inf if self._pos == len(self._md) else self._exchange_ts[self._pos]
+
+
+    def _get(self, pos:int) -> MdUpdate:
+        return self._md[pos if self._order is None else self._order[pos]]
+
+
+    def popleft(self) -> MdUpdate:
+        md = self._get(self._pos)
+        self._pos += 1
+        return md
+
+
+    def popleft_until(self, receive_ts:float) -> Optional[MdUpdate]:
+        '''
+            same as MdQueue.popleft_until, but skipped updates are never created,
+            the queue must be sorted by receive_ts
+        '''
+        n = len(self._md)
+        if self._pos == n:
+            return None
+        pos = np.searchsorted(self._receive_ts, receive_ts, side='left')
+        pos = min(max(self._pos, pos), n - 1)
+        self._pos = pos + 1
+        return self._get(pos)
+
+
+class MdStreamQueue:
+    '''
+        Queue over iterator of MdUpdate objects, updates are pulled lazily one by one
+    '''
+    def __init__(self, market_data:Iterator[MdUpdate]) -> None:
+        self._it = market_data
+        self._head = next(self._it, None)
+
+
+    def __len__(self) -> int:
+        #number of updates is unknown, only emptiness is reported
+        return 0 if self._head is None else 1
+
+
+    def head_ts(self) -> float:
+        return np.inf if self._head is None else self._head.exchange_ts
+
+
+    def popleft(self) -> MdUpdate:
+        md = self._head
+        self._head = next(self._it, None)
+        return md
+
+
+def make_md_queue(market_data:Union[List[MdUpdate], MarketData, Iterator[MdUpdate]]) \
+        -> Union[MdQueue, MdArrayQueue, MdStreamQueue]:
+    if isinstance(market_data, MarketData):
+        return MdArrayQueue(market_data)
+    if isinstance(market_data, abc.Iterator):
+        return MdStreamQueue(market_data)
+    return MdQueue(market_data)
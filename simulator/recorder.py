@@ -0,0 +1,326 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from utils import MdUpdate, OwnTrade, ExpiredOrder, BID, update_best_positions
+
+
+#what strategy keeps during run:
+#   full    - all the updates, md, own trades, placed orders and fields on every tick
+#   sampled - own trades and fields every `sample_every` nanoseconds or on ticks with own trades
+#   summary - only PnL and inventory aggregates
+#   none    - nothing
+RECORD_LEVELS = ['full', 'sampled', 'summary', 'none']
+
+#dtype of the recorded fields, float64 by default
+FIELD_DTYPES = {'receive_ts': np.int64}
+
+
+def _schema(fields:List[str]) -> np.dtype:
+    return np.dtype([ (name, FIELD_DTYPES.get(name, np.float64)) for name in fields ])
+
+
+class Recorder:
+    '''
+        Growable table with fixed fields stored in a numpy structured array.
+        Rows are appended as tuples in the order of fields, capacity is doubled when the table is full.
+    '''
+    def __init__(self, fields:List[str], capacity:int = 1024) -> None:
+        '''
+            Args:
+                fields(List[str]): names of the fields, receive_ts is int64, other fields are float64
+                capacity(int): initial number of rows
+        '''
+        self.fields = list(fields)
+        self._data = np.empty(max(capacity, 1), dtype=_schema(fields))
+        self._n = 0
+
+
+    def __len__(self) -> int:
+        return self._n
+
+
+    def _grow(self) -> None:
+        data = np.empty(2 * len(self._data), dtype=self._data.dtype)
+        data[:self._n] = self._data[:self._n]
+        self._data = data
+
+
+    def append(self, row:Tuple) -> None:
+        if self._n == len(self._data):
+            self._grow()
+        self._data[self._n] = row
+        self._n += 1
+
+
+    def __getitem__(self, name:str) -> np.ndarray:
+        return self._data[name][:self._n]
+
+
+    def to_dict(self) -> Dict[str, np.ndarray]:
+        '''
+            Returns:
+                res(Dict[str, np.ndarray]): copy of the recorded fields
+        '''
+        return { name:self[name].copy() for name in self.fields }
+
+
+class RingBuffer(Recorder):
+    '''
+        Recorder of the last rows: rows are removed from the head by moving the head index,
+        live rows are moved to the beginning of the array when it is full.
+    '''
+    def __init__(self, fields:List[str], capacity:int = 1024) -> None:
+        super().__init__(fields, capacity)
+        self._head = 0
+
+
+    def __len__(self) -> int:
+        return self._n - self._head
+
+
+    def _grow(self) -> None:
+        n = len(self)
+        #double the capacity only if more than half of the array is used
+        if 2 * n > len(self._data):
+            data = np.empty(2 * len(self._data), dtype=self._data.dtype)
+        else:
+            data = self._data
+        data[:n] = self._data[self._head:self._n]
+        self._data, self._head, self._n = data, 0, n
+
+
+    def __getitem__(self, name:str) -> np.ndarray:
+        return self._data[name][self._head:self._n]
+
+
+    def first(self, name:str):
+        return self._data[name][self._head]
+
+
+    def popleft_while_less(self, name:str, value:float) -> None:
+        '''
+            This function removes rows from the head while their field `name` is less than value,
+            the field should be non-decreasing
+        '''
+        col = self._data[name]
+        while self._head < self._n and col[self._head] < value:
+            self._head += 1
+
+
+class PnLTracker:
+    '''
+        Online PnL: positions are updated on own trades, portfolio is marked to mid price
+        after every update as in get_info.get_pnl. Values are available during the simulation.
+    '''
+    #fields of the equity curve
+    CURVE_FIELDS = ['receive_ts', 'total', 'BTC', 'USD', 'mid_price']
+
+    def __init__(self, cost=-0.00001, sample_every:Optional[float] = None) -> None:
+        '''
+            Args:
+                cost(float): fee per unit of traded notional
+                sample_every(Optional[float]): if given, equity curve is recorded
+                                               at most once per `sample_every` nanoseconds
+        '''
+        self.cost = cost
+        #current position in btc and usd
+        self.btc_pos, self.usd_pos = 0.0, 0.0
+        #fees paid, included in usd_pos
+        self.fees = 0.0
+        #best positions for updates passed to self.update
+        self.best_bid, self.best_ask = -np.inf, np.inf
+        self.mid_price = np.nan
+
+        self.n_trades = 0
+        self.volume = 0.0
+        self.notional = 0.0
+        self.max_abs_pos = 0.0
+        #maximum portfolio value and maximum drawdown from it
+        self.peak = -np.inf
+        self.max_drawdown = 0.0
+
+        self.sample_every = sample_every
+        self._last_sample = -np.inf
+        self.curve:Optional[Recorder] = Recorder(self.CURVE_FIELDS) if not sample_every is None else None
+
+
+    @property
+    def total(self) -> float:
+        '''
+            portfolio value marked to mid price
+        '''
+        return self.btc_pos * self.mid_price + self.usd_pos
+
+
+    def _mark(self, receive_ts:Optional[float]) -> None:
+        total = self.total
+        if not np.isfinite(total):
+            return
+        if total > self.peak:
+            self.peak = total
+        elif self.peak - total > self.max_drawdown:
+            self.max_drawdown = self.peak - total
+
+        if not self.curve is None and not receive_ts is None and receive_ts - self._last_sample >= self.sample_every:
+            self._last_sample = receive_ts
+            self.curve.append( (receive_ts, total, self.btc_pos, self.usd_pos, self.mid_price) )
+
+
+    def update_md(self, best_bid:float, best_ask:float, receive_ts:Optional[float] = None) -> None:
+        '''
+            This function updates mid price with best positions after md update
+        '''
+        self.best_bid, self.best_ask = best_bid, best_ask
+        self.mid_price = 0.5 * ( best_ask + best_bid )
+        self._mark(receive_ts)
+
+
+    def update_trade(self, trade:OwnTrade) -> None:
+        sgn = 1.0 if trade.side == BID else -1.0
+        notional = trade.price * trade.size
+        self.btc_pos += sgn * trade.size
+        self.usd_pos -= sgn * notional
+        self.usd_pos -= self.cost * notional
+        self.fees += self.cost * notional
+
+        self.n_trades += 1
+        self.volume += trade.size
+        self.notional += notional
+        self.max_abs_pos = max(self.max_abs_pos, abs(self.btc_pos))
+        self._mark(trade.receive_ts)
+
+
+    def update(self, update:Union[MdUpdate, OwnTrade, ExpiredOrder]) -> None:
+        '''
+            This function processes update received by strategy, best positions are tracked by PnLTracker
+        '''
+        if isinstance(update, MdUpdate):
+            best_bid, best_ask = update_best_positions(self.best_bid, self.best_ask, update)
+            self.update_md(best_bid, best_ask, update.receive_ts)
+        elif isinstance(update, OwnTrade):
+            self.update_trade(update)
+        elif isinstance(update, ExpiredOrder):
+            #expiration doesn't change positions
+            pass
+        else:
+            assert False, 'invalid type of update!'
+
+
+    def summary(self) -> Dict[str, float]:
+        '''
+            Returns:
+                res(Dict[str, float]): current PnL, maximum drawdown, number of trades, traded volume,
+                                       fees and current and maximum absolute position in BTC
+        '''
+        return {
+            'pnl': self.total,
+            'max_drawdown': self.max_drawdown,
+            'n_trades': self.n_trades,
+            'volume': self.volume,
+            'fees': self.fees,
+            'final_pos': self.btc_pos,
+            'max_abs_pos': self.max_abs_pos,
+        }
+
+
+    def equity_curve(self) -> Dict[str, np.ndarray]:
+        '''
+            Returns:
+                res(Dict[str, np.ndarray]): sampled receive_ts, total, BTC, USD and mid_price, empty without sample_every
+        '''
+        if self.curve is None:
+            return Recorder(self.CURVE_FIELDS).to_dict()
+        return self.curve.to_dict()
+
+
+class RunRecorder:
+    '''
+        Storage of the results of strategy run with the given recording level
+    '''
+    def __init__(self, level:str = 'full', fields:Optional[List[str]] = None,
+                       sample_every:Optional[float] = None, cost:float = -0.00001,
+                       equity_every:Optional[float] = None) -> None:
+        '''
+            Args:
+                level(str): one of RECORD_LEVELS
+                fields(Optional[List[str]]): fields recorded on ticks
+                sample_every(Optional[float]): sampling period in nanoseconds for 'sampled' level,
+                                               if None fields are recorded only on ticks with own trades
+                cost(float): fee per unit of traded notional for PnL aggregates
+                equity_every(Optional[float]): sampling period of the equity curve in nanoseconds,
+                                               if None equity curve is not recorded
+        '''
+        assert level in RECORD_LEVELS, "Wrong recording level!"
+        self.level = level
+        self.sample_every = sample_every
+        self._last_sample = -np.inf
+
+        self.updates:List[Any] = []
+        self.md:List[MdUpdate] = []
+        self.trades:List[OwnTrade] = []
+        self.orders:List[Any] = []
+        self.records = Recorder(fields if not fields is None else [])
+        self.pnl:Optional[PnLTracker] = PnLTracker(cost, equity_every) if level != 'none' else None
+
+
+    def add_updates(self, updates:List[Any]) -> None:
+        if self.level == 'full':
+            self.updates += updates
+
+
+    def add_md(self, md:MdUpdate, best_bid:float, best_ask:float) -> None:
+        if self.level == 'full':
+            self.md.append(md)
+        if not self.pnl is None:
+            self.pnl.update_md(best_bid, best_ask, md.receive_ts)
+
+
+    def add_trade(self, trade:OwnTrade) -> None:
+        if self.level in ('full', 'sampled'):
+            self.trades.append(trade)
+        if not self.pnl is None:
+            self.pnl.update_trade(trade)
+
+
+    def add_orders(self, orders:List[Any]) -> None:
+        if self.level == 'full':
+            self.orders += orders
+
+
+    def add_row(self, receive_ts:float, row:Callable[[], Tuple], has_trade:bool = False) -> None:
+        '''
+            This function records fields of the tick if the recording level requires it
+
+            Args:
+                receive_ts(float): timestamp of the tick
+                row(Callable[[], Tuple]): function returning values of the fields
+                has_trade(bool): True if own trades were received on the tick
+        '''
+        if self.level == 'full':
+            self.records.append(row())
+        elif self.level == 'sampled':
+            if self.sample_every is None:
+                sample = has_trade
+            else:
+                sample = receive_ts - self._last_sample >= self.sample_every
+            if sample:
+                self._last_sample = receive_ts
+                self.records.append(row())
+
+
+    def result(self) -> Dict[str, Any]:
+        '''
+            Returns:
+                res(Dict[str, Any]): recorded fields as numpy arrays, lists of trades, md, updates and orders
+                                     (empty if they are not recorded), PnL summary and equity curve
+        '''
+        res:Dict[str, Any] = self.records.to_dict()
+        res['trade'] = self.trades
+        res['md'] = self.md
+        res['update'] = self.updates
+        res['order'] = self.orders
+        if not self.pnl is None:
+            res['summary'] = self.pnl.summary()
+            res['equity'] = self.pnl.equity_curve()
+        return res
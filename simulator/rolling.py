@@ -0,0 +1,121 @@
+from collections import deque
+from typing import Deque
+
+import numpy as np
+
+
+class RollingStats:
+    '''
+        Mean and variance of the values pushed during the last T nanoseconds.
+
+        Values are added and removed with Welford updates of deviations from a reference value,
+        so push is O(1) amortized.
+        Sums are recalculated from the window after each len(window) removals to avoid error accumulation.
+        If the window contains inf or nan, statistics are calculated with numpy as np.mean and np.std do.
+    '''
+    def __init__(self, T:float) -> None:
+        '''
+            Args:
+                T(float): length of the window in nanoseconds
+        '''
+        self.T = T
+        self.ts:Deque[float] = deque()
+        self.values:Deque[float] = deque()
+        #mean and sum of squared deviations of x - shift
+        self._shift = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+        #number of inf and nan values in the window
+        self._n_bad = 0
+        #number of removals since the last recalculation
+        self._n_removed = 0
+
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+    def _n_finite(self) -> int:
+        return len(self.values) - self._n_bad
+
+
+    def _add(self, x:float) -> None:
+        n = self._n_finite()
+        if n == 1:
+            self._shift, self._mean, self._m2 = x, 0.0, 0.0
+            return
+        x -= self._shift
+        delta = x - self._mean
+        self._mean += delta / n
+        self._m2 += delta * (x - self._mean)
+
+
+    def _remove(self, x:float) -> None:
+        n = self._n_finite()
+        if n == 0:
+            self._mean, self._m2 = 0.0, 0.0
+            return
+        x -= self._shift
+        delta = x - self._mean
+        self._mean -= delta / n
+        self._m2 -= delta * (x - self._mean)
+        self._m2 = max(self._m2, 0.0)
+
+
+    def _recalculate(self) -> None:
+        finite = [x for x in self.values if np.isfinite(x)]
+        self._mean, self._m2 = 0.0, 0.0
+        self._n_removed = 0
+        if len(finite):
+            finite = np.asarray(finite)
+            self._shift = np.mean(finite)
+            self._mean = np.mean(finite - self._shift)
+            self._m2 = np.sum((finite - self._shift - self._mean) ** 2)
+
+
+    def push(self, ts:float, x:float) -> None:
+        '''
+            This function adds value x with timestamp ts and removes values older than ts - T
+        '''
+        self.ts.append(ts)
+        self.values.append(x)
+        if np.isfinite(x):
+            self._add(x)
+        else:
+            self._n_bad += 1
+
+        while len(self.ts) and ts - self.ts[0] > self.T:
+            self.ts.popleft()
+            old = self.values.popleft()
+            if np.isfinite(old):
+                self._remove(old)
+                self._n_removed += 1
+            else:
+                self._n_bad -= 1
+
+        if self._n_removed > len(self.values):
+            self._recalculate()
+
+
+    def mean(self) -> float:
+        if len(self.values) == 0:
+            return np.nan
+        if self._n_bad:
+            return np.mean(self.values)
+        return self._shift + self._mean
+
+
+    def var(self) -> float:
+        '''
+            Returns:
+                var(float): variance with ddof=0, as np.var
+        '''
+        if len(self.values) == 0:
+            return np.nan
+        if self._n_bad:
+            return np.var(self.values)
+        return self._m2 / len(self.values)
+
+
+    def std(self) -> float:
+        return np.sqrt(self.var())
@@ -1,30 +1,44 @@
 from collections import deque
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Union, Deque, Dict
+from typing import Iterator, List, Optional, Tuple, Union, Deque, Dict
 
 import numpy as np
 from sortedcontainers import SortedDict
 
-from utils import Order, CancelOrder, AnonTrade, OwnTrade, OrderbookSnapshotUpdate, MarketOrder, \
-                  MdUpdate, update_best_positions, get_mid_price, PriorQueue
+from utils import Order, CancelOrder, AmendOrder, OrderBatch, AnonTrade, OwnTrade, ExpiredOrder, OrderbookSnapshotUpdate, MarketOrder, \
+                  Side, BID, ASK, BOOK, TRADE, MdUpdate, update_best_positions, get_mid_price, BookState, PriorQueue, EventScheduler
+from market_data import MarketData, make_md_queue
+
+
+#kinds of scheduler events, md goes before action with the same timestamp,
+#expiration goes after them, so order is live at its expire_ts
+MD_EVENT = 0
+ACTION_EVENT = 1
+EXPIRE_EVENT = 2
 
 
 class Sim:
-    def __init__(self, market_data: List[MdUpdate], execution_latency: float, md_latency: float) -> None:
+    def __init__(self, market_data: Union[List[MdUpdate], MarketData, Iterator[MdUpdate]], 
+                       execution_latency: float, md_latency: float) -> None:
         '''
             Args:
-                market_data(List[MdUpdate]): market data
+                market_data(Union[List[MdUpdate], MarketData, Iterator[MdUpdate]]): market data,
+                    iterator (e.g. stream_md_from_file) is consumed lazily
                 execution_latency(float): latency in nanoseconds
                 md_latency(float): latency in nanoseconds
         '''   
-        #transform md to queue
-        self.md_queue = deque( market_data )
-        #action queue
-        self.actions_queue:Deque[ Union[Order, MarketOrder, CancelOrder] ] = deque()
+        #transform md to queue, columnar md and iterators are not copied
+        self.md_queue = make_md_queue( market_data )
+        #exchange events: head of md queue and actions, ordered by exchange_ts
+        self.events = EventScheduler()
+        self._push_md_event()
         #SordetDict: receive_ts -> [updates]
         self.strategy_updates_queue = PriorQueue()
         #map : order_id -> Order
         self.ready_to_execute_orders:Dict[int, Order] = {}
+        #resting orders indexed by side and price: price -> {order_id: number of order in book}
+        self.ladders:Dict[Side, SortedDict] = {BID: SortedDict(), ASK: SortedDict()}
+        self.n_rested = 0
         
         #current md
         self.md:Optional[MdUpdate] = None
@@ -34,27 +48,36 @@ class Sim:
         #latency
         self.latency = execution_latency
         self.md_latency = md_latency
+        #current orderbook state
+        self.book = BookState()
         #current bid and ask
         self.best_bid = -np.inf
         self.best_ask = np.inf
         #current trade 
         self.trade_price = {}
-        self.trade_price['BID'] = -np.inf
-        self.trade_price['ASK'] = np.inf
+        self.trade_price[BID] = -np.inf
+        self.trade_price[ASK] = np.inf
         #last order
         self.last_order:Optional[Order] = None
+        #number in book of the amended order if it keeps queue priority
+        self.last_order_priority:Optional[int] = None
         
     
-    def get_md_queue_event_time(self) -> np.float:
-        return np.inf if len(self.md_queue) == 0 else self.md_queue[0].exchange_ts
-    
-    
-    def get_actions_queue_event_time(self) -> np.float:
-        return np.inf if len(self.actions_queue) == 0 else self.actions_queue[0].exchange_ts
-    
-    
-    def get_strategy_updates_queue_event_time(self) -> np.float:
-        return self.strategy_updates_queue.min_key()
+    def _push_md_event(self) -> None:
+        #only the head of md queue is kept in the scheduler
+        ts = self.md_queue.head_ts()
+        if ts != np.inf:
+            self.events.push(ts, MD_EVENT)
+
+
+    def _push_action(self, action:Union[Order, MarketOrder, CancelOrder]) -> None:
+        self.events.push(action.exchange_ts, ACTION_EVENT, action)
+
+
+    def _push_expiration(self, order:Order) -> None:
+        #scheduler is the expiry index: one event per order with finite expire_ts
+        if order.expire_ts != np.inf:
+            self.events.push(order.expire_ts, EXPIRE_EVENT, order.order_id)
     
     
     def get_order_id(self) -> int:
@@ -76,15 +99,16 @@ class Sim:
 
 
     def delete_last_trade(self) -> None:
-        self.trade_price['BID'] = -np.inf
-        self.trade_price['ASK'] = np.inf
+        self.trade_price[BID] = -np.inf
+        self.trade_price[ASK] = np.inf
 
 
     def update_md(self, md:MdUpdate) -> None:
         #current orderbook
         self.md = md 
         #update position
-        self.best_bid, self.best_ask = update_best_positions(self.best_bid, self.best_ask, md)
+        self.book.update(md)
+        self.best_bid, self.best_ask = self.book.best_bid, self.book.best_ask
         #update info about last trade
         self.update_last_trade()
 
@@ -92,18 +116,45 @@ class Sim:
         self.strategy_updates_queue.push(md.receive_ts, md)
         
     
-    def update_action(self, action:Union[Order, CancelOrder]) -> None:
+    def update_action(self, action:Union[Order, CancelOrder, OrderBatch]) -> None:
         
-        if isinstance(action, Order):
+        if isinstance(action, OrderBatch):
+            #cancels and amends of the batch are applied in order, new orders are collected
+            #and crossed with the book in one pass
+            orders = []
+            for batch_action in action.actions:
+                self.update_action(batch_action)
+                if not self.last_order is None:
+                    orders.append( (self.last_order, self.last_order_priority) )
+                    self.last_order, self.last_order_priority = None, None
+            self.execute_aggressively(orders)
+        elif isinstance(action, Order):
             #self.ready_to_execute_orders[action.order_id] = action
             #save last order to try to execute it aggressively
             self.last_order = action
         elif isinstance(action, CancelOrder):    
             #cancel order
             if action.id_to_delete in self.ready_to_execute_orders:
-                self.ready_to_execute_orders.pop(action.id_to_delete)
+                self.remove_resting_order(action.id_to_delete)
+        elif isinstance(action, AmendOrder):
+            #amend is ignored if the order is already executed or canceled
+            if action.id_to_amend in self.ready_to_execute_orders:
+                old = self.ready_to_execute_orders[action.id_to_amend]
+                n = self.ladders[old.side][old.price][old.order_id]
+                self.remove_resting_order(old.order_id)
+                #amended order is executed aggressively or rests in the book as a new order
+                self.last_order = Order( action.place_ts,
+                                         action.exchange_ts,
+                                         old.order_id,
+                                         old.side,
+                                         action.size,
+                                         action.price,
+                                         old.expire_ts)
+                #order keeps its place in the queue if price is the same and size is not increased
+                if action.price == old.price and action.size <= old.size:
+                    self.last_order_priority = n
         elif isinstance(action, MarketOrder):
-            price = self.best_bid if action.side == 'ASK' else self.best_ask
+            price = self.best_bid if action.side == ASK else self.best_ask
             self.last_order = Order( action.place_ts, 
                                      action.exchange_ts, 
                                      action.order_id, 
@@ -120,33 +171,30 @@ class Sim:
 
             Returns:
                 receive_ts(float): receive timestamp in nanoseconds
-                res(List[Union[OwnTrade, MdUpdate]]): simulation result. 
+                res(List[Union[OwnTrade, MdUpdate, ExpiredOrder]]): simulation result. 
         '''
-        while True:     
-            #get event time for all the queues
-            strategy_updates_queue_et = self.get_strategy_updates_queue_event_time()
-            md_queue_et = self.get_md_queue_event_time()
-            actions_queue_et = self.get_actions_queue_event_time()
-            
-            #if both queue are empty
-            if md_queue_et == np.inf and actions_queue_et == np.inf:
-                break
-
-            #strategy queue has minimum event time
-            if strategy_updates_queue_et < min(md_queue_et, actions_queue_et):
-                break
+        #process exchange events until strategy queue has minimum event time
+        while len(self.events) and self.events.peek()[0] <= self.strategy_updates_queue.min_key():
+            ts, kind, action = self.events.pop()
 
-            call_execute = md_queue_et <= actions_queue_et
-            if md_queue_et <= actions_queue_et:
+            if kind == MD_EVENT:
                 self.update_md( self.md_queue.popleft() )
-            if actions_queue_et <= md_queue_et:
-                self.update_action( self.actions_queue.popleft() )
+                #action with the same timestamp is processed together with md
+                if self.events.peek() == (ts, ACTION_EVENT):
+                    _, _, action = self.events.pop()
+                    self.update_action( action )
+                    #execute last order aggressively
+                    self.execute_last_order()
+                #next md is scheduled after the pair, so it can't take the action
+                self._push_md_event()
+                #execute orders with current orderbook
+                self.execute_orders()
+            elif kind == EXPIRE_EVENT:
+                self.expire_order( action, ts )
+            else:
+                self.update_action( action )
                 #execute last order aggressively
                 self.execute_last_order()
-            
-            #execute orders with current orderbook
-            if call_execute:
-                self.execute_orders()
             #delete last trade
             self.delete_last_trade()
         key, res = self.strategy_updates_queue.pop()
@@ -160,86 +208,201 @@ class Sim:
         #nothing to execute
         if self.last_order is None:
             return
+        self.execute_aggressively( [(self.last_order, self.last_order_priority)] )
+
+        #delete last order
+        self.last_order = None
+        self.last_order_priority = None
+
+
+    def execute_aggressively(self, orders:List[Tuple[Order, Optional[int]]]) -> None:
+        '''
+            this function crosses new orders with current best positions in one pass:
+            crossing orders are executed, the others rest in the book in order of the list
+
+            Args:
+                orders(List[Tuple[Order, Optional[int]]]): orders and their numbers in the book, None for new number
+        '''
+        best_bid, best_ask = self.best_bid, self.best_ask
+        for order, n in orders:
+            if order.side == BID and order.price >= best_ask:
+                executed_price = best_ask
+            elif order.side == ASK and order.price <= best_bid:
+                executed_price = best_bid
+            else:
+                self.add_resting_order(order, n)
+                continue
 
-        executed_price, execute = None, None
-        #
-        if self.last_order.side == 'BID' and self.last_order.price >= self.best_ask:
-            executed_price = self.best_ask
-            execute = 'BOOK'
-        #    
-        elif self.last_order.side == 'ASK' and self.last_order.price <= self.best_bid:
-            executed_price = self.best_bid
-            execute = 'BOOK'
-
-        if not executed_price is None:
             executed_order = OwnTrade(
-                self.last_order.place_ts, # when we place the order
+                order.place_ts, # when we place the order
                 self.md.exchange_ts, #exchange ts
                 self.md.exchange_ts + self.md_latency, #receive ts
                 self.get_trade_id(), #trade id
-                self.last_order.order_id, 
-                self.last_order.side, 
-                self.last_order.size, 
-                executed_price, execute)
+                order.order_id, 
+                order.side, 
+                order.size, 
+                executed_price, BOOK)
             #add order to strategy update queue
             self.strategy_updates_queue.push(executed_order.receive_ts, executed_order)
-        else:
-            self.ready_to_execute_orders[self.last_order.order_id] = self.last_order
 
-        #delete last order
-        self.last_order = None
+
+    def add_resting_order(self, order:Order, n:Optional[int] = None) -> None:
+        '''
+            adds order to the book, n is its number in the book (priority), new number by default
+        '''
+        if n is None:
+            n = self.n_rested
+            self.n_rested += 1
+        self.ready_to_execute_orders[order.order_id] = order
+        level = self.ladders[order.side].setdefault(order.price, {})
+        level[order.order_id] = n
+
+
+    def remove_resting_order(self, order_id:int) -> Order:
+        order = self.ready_to_execute_orders.pop(order_id)
+        ladder = self.ladders[order.side]
+        level = ladder[order.price]
+        level.pop(order_id)
+        if len(level) == 0:
+            ladder.pop(order.price)
+        return order
+
+
+    def expire_order(self, order_id:int, ts:float) -> None:
+        '''
+            this function removes the order from the book at its expire_ts and notifies strategy,
+            order that is already executed or canceled is skipped.
+            Expirations after the end of market data are dropped: resting orders can't be executed any more,
+            and notifications would let strategy requote forever.
+        '''
+        if self.md_queue.head_ts() == np.inf:
+            return
+        order = self.ready_to_execute_orders.get(order_id)
+        if order is None or order.expire_ts > ts:
+            return
+        self.remove_resting_order(order_id)
+        expired = ExpiredOrder(ts, ts + self.md_latency, order_id)
+        self.strategy_updates_queue.push(expired.receive_ts, expired)
 
 
     def execute_orders(self) -> None:
-        executed_orders_id = []
-        for order_id, order in self.ready_to_execute_orders.items():
-
-            executed_price, execute = None, None
-
-            #
-            if order.side == 'BID' and order.price >= self.best_ask:
-                executed_price = order.price
-                execute = 'BOOK'
-            #    
-            elif order.side == 'ASK' and order.price <= self.best_bid:
-                executed_price = order.price
-                execute = 'BOOK'
-            #
-            elif order.side == 'BID' and order.price >= self.trade_price['ASK']:
-                executed_price = order.price
-                execute = 'TRADE'    
-            #
-            elif order.side == 'ASK' and order.price <= self.trade_price['BID']:
-                executed_price = order.price
-                execute = 'TRADE'
-
-            if not executed_price is None:
-                executed_order = OwnTrade(
-                    order.place_ts, # when we place the order
-                    self.md.exchange_ts, #exchange ts
-                    self.md.exchange_ts + self.md_latency, #receive ts
-                    self.get_trade_id(), #trade id
-                    order_id, order.side, order.size, executed_price, execute)
+        '''
+            this function executes resting orders crossed by current orderbook or last trade,
+            only price levels that cross are visited
+        '''
+        bid_ladder, ask_ladder = self.ladders[BID], self.ladders[ASK]
+        #bid is executed if its price >= best ask or ask trade price, ask is symmetric
+        bid_cross = min(self.best_ask, self.trade_price[ASK])
+        ask_cross = max(self.best_bid, self.trade_price[BID])
         
-                executed_orders_id.append(order_id)
+        #list of (number of order in book, order_id)
+        executed = []
+        if len(bid_ladder) and bid_ladder.peekitem(-1)[0] >= bid_cross:
+            for price in bid_ladder.irange(minimum=bid_cross):
+                executed.extend( (n, order_id) for order_id, n in bid_ladder[price].items() )
+        if len(ask_ladder) and ask_ladder.peekitem(0)[0] <= ask_cross:
+            for price in ask_ladder.irange(maximum=ask_cross):
+                executed.extend( (n, order_id) for order_id, n in ask_ladder[price].items() )
+        #orders are executed in order they were added to the book
+        executed.sort()
 
-                #add order to strategy update queue
-                self.strategy_updates_queue.push(executed_order.receive_ts, executed_order)
-        
-        #deleting executed orders
-        for k in executed_orders_id:
-            self.ready_to_execute_orders.pop(k)
+        for _, order_id in executed:
+            order = self.remove_resting_order(order_id)
+            if order.side == BID:
+                execute = BOOK if order.price >= self.best_ask else TRADE
+            else:
+                execute = BOOK if order.price <= self.best_bid else TRADE
+            
+            executed_order = OwnTrade(
+                order.place_ts, # when we place the order
+                self.md.exchange_ts, #exchange ts
+                self.md.exchange_ts + self.md_latency, #receive ts
+                self.get_trade_id(), #trade id
+                order_id, order.side, order.size, order.price, execute)
+
+            #add order to strategy update queue
+            self.strategy_updates_queue.push(executed_order.receive_ts, executed_order)
 
 
-    def place_order(self, ts:float, size:float, side:str, price:float) -> Order:
+    def place_order(self, ts:float, size:float, side:Union[Side, str], price:float, ttl:Optional[float] = None) -> Order:
+        '''
+            This function places limit order. Order with ttl is good-till-time:
+            exchange removes it at exchange_ts + ttl if it is still resting and strategy receives ExpiredOrder.
+            Amended order keeps its expire_ts. Side is converted to Side code, 'BID' and 'ASK' are accepted.
+        '''
         #добавляем заявку в список всех заявок
-        order = Order(ts, ts + self.latency, self.get_order_id(), side, size, price)
-        self.actions_queue.append(order)
+        exchange_ts = ts + self.latency
+        expire_ts = np.inf if ttl is None else exchange_ts + ttl
+        order = Order(ts, exchange_ts, self.get_order_id(), Side(side), size, price, expire_ts)
+        self._push_action(order)
+        self._push_expiration(order)
         return order
 
 
+    def amend_order(self, ts:float, id_to_amend:int, size:float, price:float) -> AmendOrder:
+        '''
+            This function changes size and price of the resting order atomically at exchange_ts,
+            the order keeps its id. Amend of executed or canceled order is ignored.
+            The order keeps queue priority if price is the same and size is not increased,
+            otherwise it goes to the end of the queue and can be executed aggressively at the new price.
+        '''
+        amend = AmendOrder(ts, ts + self.latency, id_to_amend, size, price)
+        self._push_action(amend)
+        return amend
+
+
+    def place_orders(self, ts:float, orders:List[Tuple[float, str, float]], ttl:Optional[float] = None) -> List[Order]:
+        '''
+            This function places several orders, exchange processes them as one event
+
+            Args:
+                ts(float): timestamp of placing
+                orders(List[Tuple[float, str, float]]): size, side and price of each order
+                ttl(Optional[float]): time-in-force of the orders in nanoseconds, None for good-till-cancel
+            Returns:
+                orders(List[Order]): placed orders
+        '''
+        return self.replace_quotes(ts, [], orders, ttl)[1]
+
+
+    def cancel_orders(self, ts:float, ids_to_delete:List[int]) -> List[CancelOrder]:
+        '''
+            This function cancels several orders, exchange processes the cancels as one event
+        '''
+        return self.replace_quotes(ts, ids_to_delete, [])[0]
+
+
+    def replace_quotes(self, ts:float, ids_to_delete:List[int], orders:List[Tuple[float, str, float]],
+                       ttl:Optional[float] = None) ->\
+        Tuple[List[CancelOrder], List[Order]]:
+        '''
+            This function cancels orders and places new ones in one event:
+            exchange applies the cancels first and then tries to execute new orders in the given order.
+            The whole batch is processed together with md of the same exchange_ts,
+            separate actions with the same exchange_ts are paired with md one by one.
+
+            Args:
+                ts(float): timestamp of placing
+                ids_to_delete(List[int]): ids of the orders to cancel
+                orders(List[Tuple[float, str, float]]): size, side and price of each new order
+                ttl(Optional[float]): time-in-force of new orders in nanoseconds, None for good-till-cancel
+            Returns:
+                cancels(List[CancelOrder]), orders(List[Order]): actions of the batch
+        '''
+        exchange_ts = ts + self.latency
+        expire_ts = np.inf if ttl is None else exchange_ts + ttl
+        cancels = [ CancelOrder(exchange_ts, id_to_delete) for id_to_delete in ids_to_delete ]
+        placed = [ Order(ts, exchange_ts, self.get_order_id(), Side(side), size, price, expire_ts)
+                   for size, side, price in orders ]
+        if len(cancels) or len(placed):
+            self._push_action( OrderBatch(exchange_ts, cancels + placed) )
+        for order in placed:
+            self._push_expiration(order)
+        return cancels, placed
+
+
     def place_market_order(self, ts, size, side) -> None:
-        market_order = MarketOrder(ts, ts + self.latency, self.get_order_id(), side, size)
+        market_order = MarketOrder(ts, ts + self.latency, self.get_order_id(), Side(side), size)
         pass
     
 
@@ -248,5 +411,5 @@ class Sim:
         #добавляем заявку на удаление
         ts += self.latency
         delete_order = CancelOrder(ts, id_to_delete)
-        self.actions_queue.append(delete_order)
+        self._push_action(delete_order)
         return delete_order
\ No newline at end of file
@@ -7,9 +7,11 @@ import pandas as pd
 from simulator import MdUpdate, Order, OwnTrade, Sim
 
 
-from utils import get_mid_price, update_best_positions
+from utils import BookState
 
 from base_strategy import BaseStrategy
+from market_data import MarketData, MdQueue, MdArrayQueue
+from rolling import RollingStats
 
 
 class StoikovStrategy(BaseStrategy):
@@ -17,6 +19,8 @@ class StoikovStrategy(BaseStrategy):
         This strategy places ask and bid order every `delay` nanoseconds.
         If the order has not been executed within `hold_time` nanoseconds, it is canceled.
     '''
+    RECORD_FIELDS = BaseStrategy.RECORD_FIELDS + ['res_price']
+
     def __init__(self, delay: float, 
                     min_pos:float, 
                     T:int, 
@@ -49,19 +53,27 @@ class StoikovStrategy(BaseStrategy):
         assert theta_policy in ['std', 'spread'], "Wrong theta policy!"
         assert res_policy in ['mid_price', 'stoikov'], "Wrong theta policy!"
 
+        #mid price or spread over the last T nanoseconds
+        self.theta_stats = RollingStats(T)
+
+
+    def _record_row(self) -> tuple:
+        return super()._record_row() + (self.res_price, )
+
 
-    def _update_lists(self):
-        super()._update_lists()
-        self.lists['res_price'].append(self.res_price)
+    def _update_queues(self):
+        super()._update_queues()
+        if self._theta_policy == 'std':
+            self.theta_stats.push(self.receive_ts, self.mid_price)
+        else:
+            self.theta_stats.push(self.receive_ts, abs(self.best_ask - self.best_bid))
 
 
     def _calc_theta(self):
         if self._theta_policy == 'std':
-            theta = np.std( self.queues['mid_price'] )
+            theta = self.theta_stats.std()
         elif self._theta_policy == 'spread':
-            theta = np.mean( 
-                np.abs(np.asarray( self.queues['best_ask'] ) - np.asarray( self.queues['best_bid'] ))
-                )
+            theta = self.theta_stats.mean()
         else:
             assert False, "Unreachable"
         return theta
@@ -89,11 +101,13 @@ class FutureStrategy(BaseStrategy):
         This strategy places ask and bid order every `delay` nanoseconds.
         If the order has not been executed within `hold_time` nanoseconds, it is canceled.
     '''
+    RECORD_FIELDS = BaseStrategy.RECORD_FIELDS + ['future_mid_price']
+
     def __init__(self, delay: float, 
                     min_pos:float, 
                     T:int, 
                     gamma: float,
-                    md: Deque[MdUpdate],
+                    md: Union[Deque[MdUpdate], MarketData],
                     theta_policy:str = 'std',
                     inventory_policy:str = 'neutral',
                     q0:float = 1.0
@@ -120,27 +134,36 @@ class FutureStrategy(BaseStrategy):
         self.mid_price = None
         self.fut_price = None
         assert theta_policy in ['std', 'spread'], "Wrong theta policy!"
+        #mid price or spread over the last T nanoseconds
+        self.theta_stats = RollingStats(T)
 
-        md = sorted(md, key=lambda x:x.receive_ts)
-        self.md_queue = deque( md )
+        if isinstance(md, MarketData):
+            self.md_queue = MdArrayQueue( md, np.argsort(md.receive_ts, kind='stable') )
+        else:
+            md = sorted(md, key=lambda x:x.receive_ts)
+            self.md_queue = MdQueue( md )
 
         self.future_md = None
         self._update_future_md()
 
 
     def _update_future_md(self):
-        if self.future_md is None:
+        new_md = self.future_md is None
+        if new_md:
             self.future_md = self.md_queue.popleft()
             self.receive_ts = self.future_md.receive_ts
-            self.future_bid_price, self.future_ask_price = -np.inf, np.inf
-        ts = self.receive_ts
-        while len(self.md_queue) and (ts - self.receive_ts) < pd.Timedelta(1, 's').delta:
-            self.future_md = self.md_queue.popleft()
-            ts = self.future_md.receive_ts
-        self.future_bid_price, self.future_ask_price = \
-            update_best_positions(self.future_bid_price, self.future_ask_price, self.future_md)
-        self.future_mid_price = 0.5 * (self.future_bid_price + self.future_ask_price)
-        self.future_mid_price = get_mid_price(self.future_mid_price, self.future_md)
+            self.future_book = BookState()
+        future_md = self.md_queue.popleft_until(self.receive_ts + pd.Timedelta(1, 's').value)
+        if not future_md is None:
+            self.future_md, new_md = future_md, True
+        #book is updated only when future md changes, derived prices are cached in it
+        if new_md:
+            self.future_book.update(self.future_md)
+        self.future_bid_price, self.future_ask_price = self.future_book.best_bid, self.future_book.best_ask
+        if self.future_book.is_snapshot:
+            self.future_mid_price = self.future_book.weighted_mid
+        else:
+            self.future_mid_price = self.future_book.mid
 
 
     def _update_md(self, md):
@@ -149,17 +172,23 @@ class FutureStrategy(BaseStrategy):
 
 
 
-    def _update_lists(self):
-        super()._update_lists()
-        self.lists['future_mid_price'].append(self.future_mid_price)
-        return
+    def _record_row(self) -> tuple:
+        return super()._record_row() + (self.future_mid_price, )
+
+
+    def _update_queues(self):
+        super()._update_queues()
+        if self._theta_policy == 'std':
+            self.theta_stats.push(self.receive_ts, self.mid_price)
+        else:
+            self.theta_stats.push(self.receive_ts, self.best_ask - self.best_bid)
 
 
     def _calc_theta(self):
         if self._theta_policy == 'std':
-            theta = np.std( self.queues['mid_price'] )
+            theta = self.theta_stats.std()
         elif self._theta_policy == 'spread':
-            theta = np.mean( np.asarray( self.queues['best_ask'] ) - np.asarray( self.queues['best_bid'] ))
+            theta = self.theta_stats.mean()
         else:
             assert False, "Unreachable"
         return theta
@@ -3,7 +3,9 @@ from typing import List, Optional, Tuple, Union, Dict
 import numpy as np
 import pandas as pd
 
-from simulator import MdUpdate, Order, OwnTrade, Sim, update_best_positions
+from simulator import MdUpdate, Order, OwnTrade, ExpiredOrder, Sim, BID, ASK, update_best_positions
+from recorder import RunRecorder
+from base_strategy import quote
 
 
 class BestPosStrategy:
@@ -25,13 +27,22 @@ class BestPosStrategy:
         self.min_pos = min_pos
 
 
-    def run(self, sim: Sim ) ->\
+    def run(self, sim: Sim, record:str = 'full', cost:float = -0.00001,
+            equity_every:Optional[float] = None, amend:bool = False, expire:bool = False) ->\
         Tuple[ List[OwnTrade], List[MdUpdate], List[ Union[OwnTrade, MdUpdate] ], List[Order] ]:
         '''
             This function runs simulation
 
             Args:
                 sim(Sim): simulator
+                record(str): recording level, one of recorder.RECORD_LEVELS, lists are empty if they are not recorded,
+                             PnL summary is available in self.recorder.pnl
+                cost(float): fee per unit of traded notional for PnL summary
+                equity_every(Optional[float]): sampling period of the equity curve in nanoseconds,
+                                               the curve is available in self.recorder.pnl.equity_curve()
+                amend(bool): if True, one order per side is kept and amended instead of placing new orders
+                expire(bool): if True, orders are placed with ttl = hold_time and expired by simulator
+                              instead of being canceled by strategy, ticks with expirations only are skipped
             Returns:
                 trades_list(List[OwnTrade]): list of our executed trades
                 md_list(List[MdUpdate]): list of market data received by strategy
@@ -40,12 +51,8 @@ class BestPosStrategy:
                 all_orders(List[Orted]): list of all placed orders
         '''
 
-        #market data list
-        md_list:List[MdUpdate] = []
-        #executed trades list
-        trades_list:List[OwnTrade] = []
-        #all updates list
-        updates_list = []
+        #market data, executed trades, all updates and placed orders
+        self.recorder = RunRecorder(record, None, None, cost, equity_every)
         #current best positions
         best_bid = -np.inf
         best_ask = np.inf
@@ -54,44 +61,57 @@ class BestPosStrategy:
         prev_time = -np.inf
         #orders that have not been executed/canceled yet
         ongoing_orders: Dict[int, Order] = {}
-        all_orders = []
+        #time-in-force of the orders, None if strategy cancels them
+        ttl = self.hold_time if expire else None
         while True:
             #get update from simulator
             receive_ts, updates = sim.tick()
             if updates is None:
                 break
             #save updates
-            updates_list += updates
+            self.recorder.add_updates(updates)
             for update in updates:
                 #update best position
                 if isinstance(update, MdUpdate):
                     best_bid, best_ask = update_best_positions(best_bid, best_ask, update)
-                    md_list.append(update)
+                    self.recorder.add_md(update, best_bid, best_ask)
                 elif isinstance(update, OwnTrade):
-                    trades_list.append(update)
+                    self.recorder.add_trade(update)
                     #delete executed trades from the dict
                     if update.order_id in ongoing_orders.keys():
                         ongoing_orders.pop(update.order_id)
+                elif isinstance(update, ExpiredOrder):
+                    ongoing_orders.pop(update.order_id, None)
                 else: 
                     assert False, 'invalid type of update!'
+            #tick with expirations only doesn't change the market, strategy doesn't requote on it
+            if all(isinstance(update, ExpiredOrder) for update in updates):
+                continue
 
             if receive_ts - prev_time >= self.delay:
                 prev_time = receive_ts
-                #place order
-                bid_order = sim.place_order( receive_ts, self.min_pos, 'BID', best_bid )
-                ask_order = sim.place_order( receive_ts, self.min_pos, 'ASK', best_ask )
-                ongoing_orders[bid_order.order_id] = bid_order
-                ongoing_orders[ask_order.order_id] = ask_order
+                if amend:
+                    #amend live orders, only new orders are recorded
+                    quotes = [ quote(sim, receive_ts, ongoing_orders, self.min_pos, BID, best_bid, ttl),
+                               quote(sim, receive_ts, ongoing_orders, self.min_pos, ASK, best_ask, ttl) ]
+                    self.recorder.add_orders([ order for order, placed in quotes if placed ])
+                else:
+                    #place order
+                    bid_order = sim.place_order( receive_ts, self.min_pos, BID, best_bid, ttl )
+                    ask_order = sim.place_order( receive_ts, self.min_pos, ASK, best_ask, ttl )
+                    ongoing_orders[bid_order.order_id] = bid_order
+                    ongoing_orders[ask_order.order_id] = ask_order
 
-                all_orders += [bid_order, ask_order]
+                    self.recorder.add_orders([bid_order, ask_order])
             
-            to_cancel = []
-            for ID, order in ongoing_orders.items():
-                if order.place_ts < receive_ts - self.hold_time:
-                    sim.cancel_order( receive_ts, ID )
-                    to_cancel.append(ID)
-            for ID in to_cancel:
-                ongoing_orders.pop(ID)
+            if not expire:
+                to_cancel = []
+                for ID, order in ongoing_orders.items():
+                    if order.place_ts < receive_ts - self.hold_time:
+                        sim.cancel_order( receive_ts, ID )
+                        to_cancel.append(ID)
+                for ID in to_cancel:
+                    ongoing_orders.pop(ID)
             
                 
-        return trades_list, md_list, updates_list, all_orders
+        return self.recorder.trades, self.recorder.md, self.recorder.updates, self.recorder.orders
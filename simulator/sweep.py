@@ -0,0 +1,105 @@
+'''
+    Parallel parameter sweep of strategies
+
+    Usage:
+        grid = {'gamma': [0.01, 0.1, 1.0], 'delay': [delay], 'min_pos': [0.001], 'T': [theta_window]}
+        df = sweep(StoikovStrategy, grid, PATH_TO_FILE, T, latency, md_latency)
+'''
+import inspect
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Union
+
+import pandas as pd
+
+from simulator import Sim
+from load_data import load_md_from_file, load_book_columns, load_trade_columns
+from market_data import MarketData
+
+
+#simulator parameters, the rest of the grid is passed to the strategy
+SIM_PARAMS = ['latency', 'md_latency']
+
+#market data of the worker process, columns are memory-mapped from the binary cache
+_md:Optional[MarketData] = None
+
+
+def param_grid(grid:Union[Dict[str, List[Any]], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    '''
+        This function expands grid of parameters to the list of configurations
+
+        Args:
+            grid(Union[Dict[str, List[Any]], List[Dict[str, Any]]]): values of each parameter or list of configurations
+        Returns:
+            configs(List[Dict[str, Any]]): all combinations of the values
+    '''
+    if isinstance(grid, list):
+        return [dict(config) for config in grid]
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def _init_worker(path:str, T:int, depth:int) -> None:
+    global _md
+    _md = load_md_from_file(path, T, depth)
+
+
+def _run_config(strategy_cls:type, config:Dict[str, Any], cost:float) -> Dict[str, Any]:
+    params = dict(config)
+    sim_params = [params.pop(k) for k in SIM_PARAMS]
+    #strategies with future price get market data as an argument
+    if 'md' in inspect.signature(strategy_cls).parameters:
+        params['md'] = _md
+
+    t = time.perf_counter()
+    strategy = strategy_cls(**params)
+    #only PnL and inventory aggregates are kept
+    strategy.run(Sim(_md, *sim_params), record='summary', cost=cost)
+    seconds = time.perf_counter() - t
+
+    return {**config, **strategy.recorder.pnl.summary(), 'seconds': seconds}
+
+
+def sweep(strategy_cls:type, grid:Union[Dict[str, List[Any]], List[Dict[str, Any]]],
+          path:str, T:int, latency:float, md_latency:float, cost:float = -0.00001,
+          depth:int = 10, n_jobs:Optional[int] = None) -> pd.DataFrame:
+    '''
+        This function runs the strategy for every configuration of the grid in a process pool.
+        Market data is converted to the binary cache once, workers memory-map it read-only.
+        Strategies run with 'summary' recording level, so memory doesn't depend on the length of the data.
+
+        Args:
+            strategy_cls(type): strategy class, e.g. StoikovStrategy
+            grid(Union[Dict[str, List[Any]], List[Dict[str, Any]]]): arguments of the strategy, can contain
+                                                                     latency and md_latency
+            path(str): path to directory with lobs.csv and trades.csv
+            T(int): max timestamp from the first one in nanoseconds
+            latency(float): default latency in nanoseconds
+            md_latency(float): default md_latency in nanoseconds
+            cost(float): fee per unit of traded notional
+            depth(int): number of orderbook levels to load
+            n_jobs(Optional[int]): number of processes, all cores by default, 1 to run in this process
+        Returns:
+            df(pd.DataFrame): one row per configuration, parameters and summary metrics
+    '''
+    configs = param_grid(grid)
+    for config in configs:
+        config.setdefault('latency', latency)
+        config.setdefault('md_latency', md_latency)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(configs)))
+
+    if n_jobs == 1:
+        _init_worker(path, T, depth)
+        rows = [_run_config(strategy_cls, config, cost) for config in configs]
+    else:
+        #build the cache before workers start, tables are not merged in this process
+        load_book_columns(path, T, depth)
+        load_trade_columns(path, T)
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(path, T, depth)) as pool:
+            rows = list(pool.map(_run_config, itertools.repeat(strategy_cls), configs, itertools.repeat(cost)))
+    return pd.DataFrame(rows)
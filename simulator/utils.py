@@ -1,44 +1,114 @@
+import heapq
 from collections import deque
-from dataclasses import dataclass
-from typing import List, Optional, Tuple, Union, Deque, Dict
+from dataclasses import dataclass, fields
+from enum import Enum
+from typing import Any, List, Optional, Tuple, Union, Deque, Dict
 
 import numpy as np
-from sortedcontainers import SortedDict
 
 
+#validation of event records (sides and execution types of orders and own trades) is done only in debug mode,
+#use set_debug to change it
+DEBUG = False
+
+
+class Side(str, Enum):
+    '''
+        Side of orders and trades. Members are strings: side == BID is True for Side.BID and for 'BID',
+        so records built with plain strings are handled the same way
+    '''
+    BID = 'BID'
+    ASK = 'ASK'
+    #str and format give 'BID' as for plain strings
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+class Execution(str, Enum):
+    '''
+        Execution type of own trades: BOOK if the order crossed the orderbook, TRADE if it was hit by market trade
+    '''
+    BOOK = 'BOOK'
+    TRADE = 'TRADE'
+    __str__ = str.__str__
+    __format__ = str.__format__
+
+
+BID, ASK = Side.BID, Side.ASK
+BOOK, TRADE = Execution.BOOK, Execution.TRADE
+
+
+def slotted(cls):
+    '''
+        Class decorator applied on top of @dataclass: creates the same dataclass with __slots__,
+        instances have no __dict__, so they are smaller and attribute access is faster.
+        (dataclass(slots=True) requires python 3.10)
+    '''
+    names = tuple(f.name for f in fields(cls))
+    dct = dict(cls.__dict__)
+    #defaults are stored in __init__, class attributes would conflict with slots
+    for name in names + ('__dict__', '__weakref__'):
+        dct.pop(name, None)
+    dct['__slots__'] = names
+    return type(cls)(cls.__name__, cls.__bases__, dct)
+
+
+@slotted
 @dataclass
 class Order:  # Our own placed order
     place_ts : float # ts when we place the order
     exchange_ts : float # ts when exchange(simulator) get the order    
     order_id: int
-    side: str
+    side: Side
     size: float
     price: float
+    expire_ts : float = np.inf # ts when exchange expires the resting order, np.inf for good-till-cancel
 
 
+@slotted
 @dataclass
 class MarketOrder:  # Our own placed order
     place_ts : float # ts when we place the order
     exchange_ts : float # ts when exchange(simulator) get the order    
     order_id: int
-    side: str
+    side: Side
     size: float
 
         
+@slotted
 @dataclass
 class CancelOrder:
     exchange_ts: float
     id_to_delete : int
 
+@slotted
+@dataclass
+class AmendOrder:  # New size and price of our resting order
+    place_ts : float # ts when we amend the order
+    exchange_ts : float
+    id_to_amend : int
+    size: float
+    price: float
+
+
+@slotted
+@dataclass
+class OrderBatch:  # Group of our actions with one exchange ts, processed by exchange as one event
+    exchange_ts: float
+    actions : List[Union[Order, CancelOrder, AmendOrder]]
+
+
+@slotted
 @dataclass
 class AnonTrade:  # Market trade
     exchange_ts : float
     receive_ts : float
-    side: str
+    side: Side
     size: float
     price: float
 
 
+@slotted
 @dataclass
 class OwnTrade:  # Execution of own placed order
     place_ts : float # ts when we call place_order method, for debugging
@@ -46,16 +116,21 @@ class OwnTrade:  # Execution of own placed order
     receive_ts: float
     trade_id: int
     order_id: int
-    side: str
+    side: Side
     size: float
     price: float
-    execute : str # BOOK or TRADE
+    execute : Execution
 
 
-    def __post_init__(self):
-        assert isinstance(self.side, str)
+@slotted
+@dataclass
+class ExpiredOrder:  # Our resting order removed by exchange at its expire_ts
+    exchange_ts: float
+    receive_ts: float
+    order_id: int
 
 
+@slotted
 @dataclass
 class OrderbookSnapshotUpdate:  # Orderbook tick snapshot
     exchange_ts : float
@@ -64,6 +139,54 @@ class OrderbookSnapshotUpdate:  # Orderbook tick snapshot
     bids: List[Tuple[float, float]]
 
 
+class BookRow(OrderbookSnapshotUpdate):
+    '''
+        Orderbook snapshot backed by the i-th row of columnar books (market_data.BookColumns).
+        Best positions are read from the arrays, lists of levels are created on the first access.
+    '''
+    __slots__ = ('books', 'i', 'best_bid', 'best_ask', '_asks', '_bids')
+
+    def __init__(self, books, i:int) -> None:
+        self.books = books
+        self.i = i
+        self.exchange_ts = int(books.exchange_ts[i])
+        self.receive_ts = int(books.receive_ts[i])
+        self.best_bid = float(books.bid_price[i, 0])
+        self.best_ask = float(books.ask_price[i, 0])
+        self._asks:Optional[List[Tuple[float, float]]] = None
+        self._bids:Optional[List[Tuple[float, float]]] = None
+
+
+    @property
+    def asks(self) -> List[Tuple[float, float]]:
+        if self._asks is None:
+            self._asks = list(zip(self.books.ask_price[self.i].tolist(), self.books.ask_vol[self.i].tolist()))
+        return self._asks
+
+
+    @property
+    def bids(self) -> List[Tuple[float, float]]:
+        if self._bids is None:
+            self._bids = list(zip(self.books.bid_price[self.i].tolist(), self.books.bid_vol[self.i].tolist()))
+        return self._bids
+
+
+    def __eq__(self, other) -> bool:
+        #equal to OrderbookSnapshotUpdate with the same fields
+        if not isinstance(other, OrderbookSnapshotUpdate):
+            return NotImplemented
+        return (self.exchange_ts, self.receive_ts, self.asks, self.bids) == \
+               (other.exchange_ts, other.receive_ts, other.asks, other.bids)
+
+    __hash__ = None
+
+
+    def __reduce__(self):
+        #pickled as plain snapshot, books are not copied
+        return (OrderbookSnapshotUpdate, (self.exchange_ts, self.receive_ts, self.asks, self.bids))
+
+
+@slotted
 @dataclass
 class MdUpdate:  # Data of a tick
     exchange_ts : float
@@ -73,10 +196,46 @@ class MdUpdate:  # Data of a tick
 
 
 
+def _check_side(record:Union[Order, OwnTrade]) -> None:
+    assert isinstance(record.side, Side), "wrong side!"
+
+
+def _check_own_trade(trade:OwnTrade) -> None:
+    _check_side(trade)
+    assert isinstance(trade.execute, Execution), "wrong execution type!"
+
+
+#event records validated in debug mode: class -> (__init__ without validation, validation)
+_CHECKS = {
+    Order: (Order.__init__, _check_side),
+    OwnTrade: (OwnTrade.__init__, _check_own_trade),
+}
+
+
+def set_debug(debug:bool) -> None:
+    '''
+        This function turns on or off validation of event records on construction.
+        Without debug mode records are constructed by dataclass __init__ without any checks.
+    '''
+    global DEBUG
+    DEBUG = debug
+    for cls, (init, check) in _CHECKS.items():
+        if debug:
+            def checked_init(self, *args, _init=init, _check=check, **kwargs):
+                _init(self, *args, **kwargs)
+                _check(self)
+            cls.__init__ = checked_init
+        else:
+            cls.__init__ = init
+
+
 def update_best_positions(best_bid:float, best_ask:float, md:MdUpdate) -> Tuple[float, float]:
-    if not md.orderbook is None:
-        best_bid = md.orderbook.bids[0][0]
-        best_ask = md.orderbook.asks[0][0]
+    book = md.orderbook
+    if type(book) is BookRow:
+        best_bid, best_ask = book.best_bid, book.best_ask
+    elif not book is None:
+        best_bid = book.bids[0][0]
+        best_ask = book.asks[0][0]
     elif not md.trade is None:
         if md.trade.side == 'BID':
             best_ask = max(md.trade.price, best_ask)
@@ -92,41 +251,227 @@ def get_mid_price(mid_price:float, md:MdUpdate):
     book = md.orderbook
     if book is None:
         return mid_price
+    return book_mid_price(book.asks, book.bids)
 
+
+def book_mid_price(asks:List[Tuple[float, float]], bids:List[Tuple[float, float]]) -> float:
+    '''
+        volume weighted price of all the levels of the orderbook
+    '''
     price = 0.0
     pos   = 0.0
 
-    for i in range( len(book.asks) ):
-        price += book.asks[i][0] * book.asks[i][1]
-        pos   += book.asks[i][1]
-        price += book.bids[i][0] * book.bids[i][1]
-        pos   += book.bids[i][1]
+    for i in range( len(asks) ):
+        price += asks[i][0] * asks[i][1]
+        pos   += asks[i][1]
+        price += bids[i][0] * bids[i][1]
+        pos   += bids[i][1]
     price /= pos
     return price
 
 
+class BookState:
+    '''
+        Orderbook state shared by simulator and strategies.
+
+        Best positions are updated in place from md updates,
+        snapshots of columnar books (BookRow) are read from the arrays without creating lists of levels.
+        Quantities derived from the levels of the last snapshot (volume weighted mid price, imbalance)
+        are calculated on the first access and cached until the next snapshot.
+    '''
+    __slots__ = ('best_bid', 'best_ask', 'is_snapshot', '_asks', '_bids', '_row',
+                 '_weighted_mid', '_imbalance', '_first_mid')
+
+    def __init__(self) -> None:
+        self.best_bid = -np.inf
+        self.best_ask = np.inf
+        #True if the last update contained orderbook snapshot
+        self.is_snapshot = False
+        #levels of the last snapshot, or BookRow which levels are not read yet
+        self._asks:Optional[List[Tuple[float, float]]] = None
+        self._bids:Optional[List[Tuple[float, float]]] = None
+        self._row:Optional[BookRow] = None
+        #cache of the derived quantities: weighted mid price and k -> imbalance
+        self._weighted_mid:Optional[float] = None
+        self._imbalance:Dict[int, float] = {}
+        #mid price after the first update, weighted mid price before the first snapshot
+        self._first_mid:Optional[float] = None
+
+
+    def _new_snapshot(self) -> None:
+        self.is_snapshot = True
+        self._weighted_mid = None
+        if len(self._imbalance):
+            self._imbalance = {}
+
+
+    def update(self, md:MdUpdate) -> None:
+        '''
+            This function updates best positions as update_best_positions does
+        '''
+        book = md.orderbook
+        if type(book) is BookRow:
+            if not book is self._row:
+                self._asks, self._bids, self._row = None, None, book
+                self._new_snapshot()
+            self.is_snapshot = True
+            self.best_bid = book.best_bid
+            self.best_ask = book.best_ask
+        elif not book is None:
+            if not (book.asks is self._asks and book.bids is self._bids):
+                self._asks, self._bids, self._row = book.asks, book.bids, None
+                self._new_snapshot()
+            self.is_snapshot = True
+            self.best_bid = book.bids[0][0]
+            self.best_ask = book.asks[0][0]
+        else:
+            self.is_snapshot = False
+            if not md.trade is None:
+                self.update_trade(md.trade.side, md.trade.price)
+        assert self.best_ask > self.best_bid, "wrong best positions"
+        if self._first_mid is None:
+            self._first_mid = self.mid
+
+
+    def update_trade(self, side:Side, price:float) -> None:
+        '''
+            market trade on BID side can only increase best ask, trade on ASK side can only decrease best bid
+        '''
+        if side == 'BID':
+            self.best_ask = max(price, self.best_ask)
+        elif side == 'ASK':
+            self.best_bid = min(self.best_bid, price)
+        else:
+            assert False, "WRONG TRADE SIDE"
+
+
+    def levels(self) -> Tuple[List[Tuple[float, float]], List[Tuple[float, float]]]:
+        '''
+            Returns:
+                asks, bids(List[Tuple[float, float]]): (price, size) levels of the last snapshot
+        '''
+        if self._asks is None and not self._row is None:
+            self._asks, self._bids = self._row.asks, self._row.bids
+        return self._asks, self._bids
+
+
+    @property
+    def mid(self) -> float:
+        return 0.5 * ( self.best_ask + self.best_bid )
+
+
+    @property
+    def spread(self) -> float:
+        return self.best_ask - self.best_bid
+
+
+    @property
+    def weighted_mid(self) -> Optional[float]:
+        '''
+            volume weighted price of the last snapshot (get_mid_price),
+            mid price after the first update if there were no snapshots
+        '''
+        if self._weighted_mid is None:
+            asks, bids = self.levels()
+            if asks is None:
+                return self._first_mid
+            self._weighted_mid = book_mid_price(asks, bids)
+        return self._weighted_mid
+
+
+    def imbalance(self, k:int = 1) -> float:
+        '''
+            Returns:
+                imbalance(float): bid volume / (bid volume + ask volume) of the first k levels of the last snapshot
+        '''
+        res = self._imbalance.get(k)
+        if res is None:
+            asks, bids = self.levels()
+            if asks is None:
+                return np.nan
+            bid_vol = sum(size for _, size in bids[:k])
+            ask_vol = sum(size for _, size in asks[:k])
+            res = self._imbalance[k] = bid_vol / (bid_vol + ask_vol)
+        return res
+
+
 class PriorQueue:
+    '''
+        Priority queue, pop returns minimum key and all the values with this key in order of pushing.
+        Keys are nearly monotone (receive_ts), so in-order pushes go to a deque,
+        out-of-order pushes go to a heap.
+    '''
     def __init__(self, default_key=np.inf, default_val = None):
-        self._queue = SortedDict()
-        self._min_key = np.inf
+        #(key, seq, val) with non-decreasing keys
+        self._queue:Deque[Tuple[float, int, Any]] = deque()
+        #(key, seq, val) pushed out of order
+        self._heap:List[Tuple[float, int, Any]] = []
+        self._seq = 0
 
     
     def push(self, key, val):
-        if key not in self._queue:
-            self._queue[key] = []
-        self._queue[key].append(val)
-        self._min_key = min(self._min_key, key)
+        item = (key, self._seq, val)
+        self._seq += 1
+        if len(self._queue) == 0 or key >= self._queue[-1][0]:
+            self._queue.append(item)
+        else:
+            heapq.heappush(self._heap, item)
 
     
     def pop(self):
-        if len(self._queue) == 0:
+        key = self.min_key()
+        if key == np.inf:
             return np.inf, None
-        res = self._queue.popitem(0)
-        self._min_key = np.inf
-        if len(self._queue):
-            self._min_key = self._queue.peekitem(0)[0]
-        return res
+        items = []
+        while len(self._queue) and self._queue[0][0] == key:
+            items.append(self._queue.popleft())
+        if len(self._heap) and self._heap[0][0] == key:
+            while len(self._heap) and self._heap[0][0] == key:
+                items.append(heapq.heappop(self._heap))
+            #restore order of pushing
+            items.sort(key=lambda item: item[1])
+        return key, [item[2] for item in items]
     
 
     def min_key(self):
-        return self._min_key
\ No newline at end of file
+        key = self._queue[0][0] if len(self._queue) else np.inf
+        if len(self._heap) and self._heap[0][0] < key:
+            key = self._heap[0][0]
+        return key
+
+
+class EventScheduler:
+    '''
+        Binary heap of events (ts, kind, seq, payload).
+        Events are popped by ts, events with the same ts are popped by kind
+        and then in order of pushing.
+    '''
+    def __init__(self):
+        self._heap = []
+        self._seq = 0
+
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+
+    @property
+    def n_pushed(self) -> int:
+        #number of events pushed so far
+        return self._seq
+
+
+    def push(self, ts, kind:int, payload:Any = None) -> None:
+        heapq.heappush(self._heap, (ts, kind, self._seq, payload))
+        self._seq += 1
+
+
+    def pop(self) -> Tuple[float, int, Any]:
+        ts, kind, _, payload = heapq.heappop(self._heap)
+        return ts, kind, payload
+
+
+    def peek(self) -> Tuple[float, Optional[int]]:
+        if len(self._heap) == 0:
+            return np.inf, None
+        return self._heap[0][0], self._heap[0][1]